@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# links the bundled gold lists (eng/rus/uk _gpe/_per.txt) and reports latency, throughput, accuracy and index size
+# as JSON, for each --backend
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from linking import EntityLinker, ExactNameIndex, Indexer, SqliteIndexer, BACKENDS, CANDIDATE_TYPES, index_kb, \
+    percentile
+from unidecode import unidecode
+
+GOLD_LISTS = ['eng_gpe.txt', 'eng_per.txt', 'rus_gpe.txt', 'rus_per.txt', 'uk_gpe.txt', 'uk_per.txt']
+PATHS = ('exact', 'fuzzy', 'unidecode', 'none')
+
+
+def read_gold(path):
+    # (mention, set of acceptable KB ids, KB entries) per line, an empty id set means 'none'
+    ent_type = 'PER' if path.endswith('_per.txt') else 'GPE'
+    gold = []
+    with open(path, 'r') as f:
+        for line in f:
+            tokens = [token.strip() for token in line.rstrip('\n').split('\t')]
+            if len(tokens) < 3 or not tokens[0]:
+                continue
+            entries = []
+            for token in tokens[2:]:
+                if token.startswith('[') and token.endswith(']'):
+                    fields = [field.strip() for field in token[1:-1].split(',')]
+                    entries.append(fields)
+            gold.append(({'mention': tokens[0], 'type': 'ldcOnt:' + ent_type},
+                         set(fields[0] for fields in entries), entries))
+    return gold
+
+
+def latency_summary(seconds):
+    return {'count': len(seconds),
+            'mean_ms': 1000. * sum(seconds) / len(seconds) if seconds else None,
+            'p50_ms': 1000. * percentile(seconds, 50) if seconds else None,
+            'p95_ms': 1000. * percentile(seconds, 95) if seconds else None,
+            'p99_ms': 1000. * percentile(seconds, 99) if seconds else None}
+
+
+# --
+# synthetic KB
+
+SYLLABLES = ['ka', 'ro', 'vi', 'ne', 'tsk', 'ov', 'ma', 'li', 'gor', 'sk', 'an', 'do', 'za', 'pe', 'tri', 'mir']
+
+def synthetic_name(rnd):
+    return ' '.join(''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))).capitalize()
+                    for _ in range(rnd.randint(1, 2)))
+
+def synthetic_kb(gold_lists, size, seed=0):
+    # KB documents for the gold entities, some of their mentions as alternate names,
+    # and `size` random distractors, some sharing a word with a gold entity
+    rnd = random.Random(seed)
+    docs = []
+    words = []
+    for gold in gold_lists:
+        for ne, ids, entries in gold:
+            ent_type = ne['type'][7:10]
+            for k, fields in enumerate(entries):
+                if ent_type == 'GPE':
+                    info = '\t'.join([fields[2] if len(fields) > 2 else '', 'city,village,...', ''])
+                else:
+                    info = ' '.join(fields[2:]).strip()
+                docs.append((fields[0], fields[1], fields[1], ent_type, info))
+                words.extend(fields[1].split())
+                if k == 0 and rnd.random() < 0.5:
+                    docs.append((fields[0], ne['mention'], fields[1], ent_type, info))
+    for i in range(size):
+        name = synthetic_name(rnd)
+        if words and rnd.random() < 0.2:
+            name = rnd.choice(words) + ' ' + name
+        ent_type = rnd.choice(['GPE', 'GPE', 'LOC', 'PER', 'PER', 'ORG'])
+        info = '\t'.join([rnd.choice(['RU', 'UA', 'US']), rnd.choice(['city,village,...', 'country,state,region,...']),
+                          rnd.choice(['', 'http://en.wikipedia.org/wiki/' + name.replace(' ', '_')])])
+        docs.append((str(90000000 + i), name, name, ent_type, info if ent_type in ('GPE', 'LOC') else ''))
+    for doc in docs:
+        yield doc
+        # same as linking.kb_documents
+        normed_name = unidecode(doc[1].decode('utf-8'))
+        if normed_name != doc[1]:
+            yield (doc[0], normed_name) + doc[2:]
+
+def build_synthetic_index(index_dir, gold_lists, size, seed=0, exact=False, backend='lucene'):
+    if backend == 'sqlite':
+        indexer = SqliteIndexer(index_path(index_dir, backend))
+    else:
+        indexer = Indexer(index_path(index_dir, backend))
+    exact_index = ExactNameIndex(os.path.join(index_dir, 'exact_names.sqlite')) if exact else None
+    index_kb(indexer, synthetic_kb(gold_lists, size, seed), exact_index=exact_index)
+    indexer.close()
+    if exact_index is not None:
+        exact_index.close()
+# --
+
+
+def index_path(index_dir, backend):
+    # where linking.py --index --backend puts it
+    if backend == 'sqlite':
+        return os.path.join(index_dir, 'sqlite_index.sqlite')
+    return os.path.join(index_dir, 'lucene_index/')
+
+
+def index_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, fname)) for root, dirs, files in os.walk(path) for fname in files)
+
+
+def link_path(linker, ne, result):
+    # which stage of EntityLinker.query answered: exact name search, fuzzy search or the unidecode retry
+    if result == 'none':
+        return 'none'
+    ent_name, ent_type = ne['mention'].lower(), ne['type'][7:10]
+    exact = linker.score_candidates(linker.search_candidates(ent_name, 0, CANDIDATE_TYPES[ent_type]),
+                                    ent_name, ent_type)
+    if exact:
+        return 'exact'
+    if linker._query_batch([(ne, '')])[0] != 'none':
+        return 'fuzzy'
+    return 'unidecode'
+
+
+def run_list(linker, gold, repeat=1):
+    # per mention: (path, correct, latencies), plus the wall time of the serial and the batched runs
+    mentions = [(ne, '') for ne, ids, entries in gold]
+    seconds = [[] for _ in gold]
+    results = None
+    start = time.time()
+    for _ in range(repeat):
+        results = []
+        for i, (ne, sentence) in enumerate(mentions):
+            t = time.time()
+            results.append(linker.query(ne, sentence))
+            seconds[i].append(time.time() - t)
+    serial = time.time() - start
+
+    start = time.time()
+    for _ in range(repeat):
+        batch_results = linker.query_batch(mentions)
+    batch = time.time() - start
+
+    linked = []
+    for (ne, ids, entries), result, times, batch_result in zip(gold, results, seconds, batch_results):
+        correct = (result == 'none' and not ids) or (result != 'none' and result[0]['id'] in ids)
+        linked.append((link_path(linker, ne, result), correct, times, result_ids(result) == result_ids(batch_result)))
+    return linked, serial, batch
+
+
+def result_ids(result):
+    return result if result == 'none' else [candidate['id'] for candidate in result]
+
+
+def summarize(linked, serial, batch, repeat=1):
+    total = len(linked) * repeat
+    report = {'mentions': len(linked),
+              'accuracy': float(sum(1 for path, correct, times, same in linked if correct)) / len(linked) if linked else None,
+              'throughput': {'serial_per_s': total / serial if serial else None,
+                             'batch_per_s': total / batch if batch else None},
+              'latency': latency_summary([t for path, correct, times, same in linked for t in times]),
+              'batch_matches_serial': all(same for path, correct, times, same in linked),
+              'paths': {}}
+    for name in PATHS:
+        report['paths'][name] = latency_summary([t for path, correct, times, same in linked if path == name for t in times])
+        report['paths'][name]['mentions'] = sum(1 for path, correct, times, same in linked if path == name)
+        report['paths'][name]['correct'] = sum(1 for path, correct, times, same in linked if path == name and correct)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index-dir', type=str,
+                        help="index to benchmark (see linking.py --index), with --synthetic the KB is built here")
+    parser.add_argument('--country-codes', nargs='*', default=[])
+    parser.add_argument('--lists', nargs='*', default=GOLD_LISTS)
+    parser.add_argument('--synthetic', type=int, default=None, metavar='N',
+                        help="build a KB from the gold entities plus N random ones, no LDC data needed")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', nargs='+', choices=BACKENDS, default=['lucene'],
+                        help="candidate search backends to compare, each needs its index in --index-dir")
+    parser.add_argument('--exact-index', action='store_true')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', type=str, help="also write the JSON report to this file")
+    args = parser.parse_args()
+    if args.index_dir is None and args.synthetic is None:
+        sys.exit('ERROR: give --index-dir, --synthetic or both')
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    gold_lists = [read_gold(path if os.path.exists(path) else os.path.join(base_dir, path)) for path in args.lists]
+
+    index_dir = args.index_dir
+    tmp_dir = None
+    index_seconds = {}
+    if args.synthetic is not None:
+        if index_dir is None:
+            index_dir = tmp_dir = tempfile.mkdtemp(prefix='linking_benchmark_')
+        for k, backend in enumerate(args.backend):
+            start = time.time()
+            # the exact index is shared by the backends
+            build_synthetic_index(index_dir, gold_lists, args.synthetic, args.seed, args.exact_index and k == 0,
+                                  backend)
+            index_seconds[backend] = time.time() - start
+            sys.stderr.write("synthetic KB indexed for {} in {:.1f}s\n".format(backend, index_seconds[backend]))
+
+    try:
+        exact_index_path = os.path.join(index_dir, 'exact_names.sqlite') if args.exact_index else None
+        report = {'index_dir': None if tmp_dir else index_dir, 'synthetic': args.synthetic,
+                  'country_codes': args.country_codes, 'exact_index': args.exact_index,
+                  'repeat': args.repeat, 'backends': {}}
+        for backend in args.backend:
+            linker = EntityLinker(index_path(index_dir, backend), args.country_codes,
+                                  exact_index_path=exact_index_path, backend=backend)
+            backend_report = report['backends'][backend] = {
+                'index_bytes': index_size(index_path(index_dir, backend)),
+                'index_seconds': index_seconds.get(backend), 'lists': {}}
+            all_linked, all_serial, all_batch = [], 0., 0.
+            for path, gold in zip(args.lists, gold_lists):
+                linked, serial, batch = run_list(linker, gold, args.repeat)
+                backend_report['lists'][os.path.basename(path)] = summarize(linked, serial, batch, args.repeat)
+                all_linked += linked
+                all_serial += serial
+                all_batch += batch
+            backend_report['total'] = summarize(all_linked, all_serial, all_batch, args.repeat)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    output = json.dumps(report, indent=1, sort_keys=True)
+    print output
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
@@ -1,24 +1,31 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
 
+import time
+IMPORT_START = time.time()
 import io
-import lucene
-from java.nio.file import Paths
-from org.apache.lucene.analysis.miscellaneous import LimitTokenCountAnalyzer
-from org.apache.lucene.analysis.standard import StandardAnalyzer
-from org.apache.lucene.index import IndexWriter, IndexWriterConfig
-from org.apache.lucene.document import Document, Field, StringField, TextField
-from org.apache.lucene.store import SimpleFSDirectory
-from org.apache.lucene.queryparser.classic import QueryParser
-from org.apache.lucene.search import IndexSearcher
-from org.apache.lucene.index import DirectoryReader
-
 import json
 import sys
 import os
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 import csv
 import traceback
+import hashlib
+import sqlite3
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import fcntl
+import re
+import math
+import threading
+import Queue
+import atexit
+import cProfile
+import BaseHTTPServer
+import SocketServer
+from array import array
+from bisect import bisect_left
+from decimal import Decimal
 
 # --
 # https://pypi.org/project/Unidecode/
@@ -26,66 +33,375 @@ import traceback
 from unidecode import unidecode
 # --
 
+# --
+# optional, reads CSR documents incrementally for --run_csr --stream
+# pip install ijson
+try:
+    import ijson
+except ImportError:
+    ijson = None
+# --
+
+# seconds spent before linking starts, see startup_report()
+startup_times = OrderedDict()
+startup_times['imports'] = time.time() - IMPORT_START
+
+# --
+# lucene and the java classes are bound by init_lucene(), the JVM only starts once something searches or indexes
+lucene = None
+JVM_ARGS = ['-Djava.awt.headless=true']
+_lucene_lock = threading.Lock()
+_jvm_thread = threading.local()
+
+def init_lucene():
+    # starts the JVM on first use and attaches the calling thread, cheap once both happened
+    global lucene, Paths, LimitTokenCountAnalyzer, StandardAnalyzer, IndexWriter, IndexWriterConfig, \
+        TieredMergePolicy, Document, Field, StringField, TextField, SimpleFSDirectory, NIOFSDirectory, \
+        MMapDirectory, Constants, CharTermAttribute, IndexSearcher, BooleanQuery, BooleanClause, TermQuery, \
+        FuzzyQuery, DirectoryReader, Term, Runtime
+    if getattr(_jvm_thread, 'attached', False):
+        return
+    with _lucene_lock:
+        if lucene is None:
+            start = time.time()
+            import lucene as _lucene
+            _lucene.initVM(vmargs=JVM_ARGS)
+            from java.lang import Runtime
+            from java.nio.file import Paths
+            from org.apache.lucene.analysis.miscellaneous import LimitTokenCountAnalyzer
+            from org.apache.lucene.analysis.standard import StandardAnalyzer
+            from org.apache.lucene.index import IndexWriter, IndexWriterConfig, TieredMergePolicy
+            from org.apache.lucene.document import Document, Field, StringField, TextField
+            from org.apache.lucene.store import SimpleFSDirectory, NIOFSDirectory, MMapDirectory
+            from org.apache.lucene.util import Constants
+            from org.apache.lucene.analysis.tokenattributes import CharTermAttribute
+            from org.apache.lucene.search import IndexSearcher, BooleanQuery, BooleanClause, TermQuery, FuzzyQuery
+            from org.apache.lucene.index import DirectoryReader, Term
+            lucene = _lucene
+            startup_times['jvm'] = time.time() - start
+            _jvm_thread.attached = True
+            return
+    lucene.getVMEnv().attachCurrentThread()
+    _jvm_thread.attached = True
+
+def startup_report():
+    return ', '.join('{} {:.2f}s'.format(name, seconds) for name, seconds in startup_times.items())
+# --
+
 # nasty hack to fix "UnicodeDecodeError: ascii codec can't decode..."
 # stackoverflow.com/questions/3828723/why-should-we-not-use-sys-setdefaultencodingutf-8-in-a-py-script
 reload(sys)
 sys.setdefaultencoding('utf8')
 
 
-def data_cleaning(table_in, table_out, country_codes):
+def percentile(values, p):
+    # nearest rank
+    if not len(values):
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100. * len(values))) - 1)]
+
+
+class Profiler(object):
+    # timings and counters of the hot paths for --profile, nothing is recorded unless enabled
+    def __init__(self):
+        self.enabled = False
+        self.times = defaultdict(lambda: array('d'))
+        self.counts = defaultdict(int)
+
+    def start(self):
+        return time.time() if self.enabled else None
+
+    def stop(self, name, start):
+        if start is not None:
+            self.times[name].append(time.time() - start)
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self.times[name].append(seconds)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] += n
+
+    def report(self):
+        lines = ['{:<20} {:>9} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+            'timer', 'count', 'total_s', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms')]
+        for name in sorted(self.times):
+            times = self.times[name]
+            lines.append('{:<20} {:>9} {:>10.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+                name, len(times), sum(times), 1000. * sum(times) / len(times),
+                1000. * percentile(times, 50), 1000. * percentile(times, 95), 1000. * percentile(times, 99)))
+        for name in sorted(self.counts):
+            lines.append('{:<20} {:>9}'.format(name, self.counts[name]))
+        return '\n'.join(lines)
+
+profiler = Profiler()
+
+
+def read_lines(f):
+    # (byte offset, line) pairs, offsets stay valid for f.seek()
+    offset = 0
+    for line in f:
+        yield offset, line
+        offset += len(line)
+
+
+def int_id(eid):
+    # KB ids are mostly decimal numbers, keep those as ints
+    if eid.isdigit() and len(eid) < 19 and (eid == '0' or eid[0] != '0'):
+        return int(eid)
+    return None
+
+
+class IdTable(object):
+    # eid -> offset of its line in entities.tab, numeric ids live in sorted arrays
+    def __init__(self):
+        self.ids = array('l')
+        self.offsets = array('l')
+        self.ascending = True
+        self.other = {}
+
+    def add(self, eid, offset):
+        n = int_id(eid)
+        if n is None:
+            self.other[eid] = offset
+            return
+        if self.ids and n < self.ids[-1]:
+            self.ascending = False
+        self.ids.append(n)
+        self.offsets.append(offset)
+
+    def freeze(self):
+        if self.ascending:
+            return
+        order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array('l', (self.ids[i] for i in order))
+        self.offsets = array('l', (self.offsets[i] for i in order))
+        self.ascending = True
+
+    def get(self, eid):
+        n = int_id(eid)
+        if n is None:
+            return self.other.get(eid)
+        i = bisect_left(self.ids, n)
+        if i < len(self.ids) and self.ids[i] == n:
+            return self.offsets[i]
+        return None
+
+
+def clean_kb_lines(rows, country_codes):
+    # rows are (offset, line) pairs
     eids = set()
+    for offset, line in rows:
+        tokens = line.strip('\n').split('\t')
+        origin, etype, eid, name = tokens[0], tokens[1], tokens[2], tokens[3]
+        key = int_id(eid)
+        if key is None:
+            key = eid
+        if key in eids:
+            continue
+        if origin == 'GEO':
+            country_code = tokens[12]
+            wiki_link = tokens[46]
+            if country_codes and country_code not in country_codes and wiki_link == '':
+                continue
+        eids.add(key)
+        yield offset, line
+
+
+def data_cleaning(table_in, table_out, country_codes):
     with open(table_in, 'r') as fin:
         with open(table_out, 'w') as fout:
-            for line in fin:
-                tokens = line.strip('\n').split('\t')
-                origin, etype, eid, name = tokens[0], tokens[1], tokens[2], tokens[3]
-                if eid in eids:
-                    continue
-                if origin == 'GEO':
-                    country_code = tokens[12]
-                    wiki_link = tokens[46]
-                    if country_codes and country_code not in country_codes and wiki_link == '':
-                        continue
-                eids.add(eid)
+            for offset, line in clean_kb_lines(read_lines(fin), country_codes):
                 fout.write(line)
 
 
-def load_id2name(kb_path, alias_path):
-    id2name = {}
-    id2type = {}
-    id2info = {}
+def parse_kb_line(line):
+    tokens = line[:-1].split('\t')
+    eid, name, type = tokens[2], tokens[3], tokens[1]
+    src = tokens[0]
+    if src == 'GEO':
+        info = '\t'.join([tokens[12], tokens[8], tokens[46]])
+    elif src == 'WLL':
+        info = '\t'.join([tokens[26], tokens[27], tokens[28]])
+    elif src == 'APB':
+        info = tokens[35]
+    else:
+        info = ''
+    return eid, name, type, info
+
+
+def load_id2name(kb_path, alias_path, country_codes=()):
+    # only offsets are kept per entity, alternate names re-read their entity's line
+    id2offset = IdTable()
     with open(kb_path, 'r') as f:
-        f.readline()
-        for line in f:
-            tokens = line[:-1].split('\t')
-            eid, name, type = tokens[2], tokens[3], tokens[1]
-            src = tokens[0]
-            if src == 'GEO':
-                info = '\t'.join([tokens[12], tokens[8], tokens[46]])
-            elif src == 'WLL':
-                info = '\t'.join([tokens[26], tokens[27], tokens[28]])
-            elif src == 'APB':
-                info = tokens[35]
-            else:
-                info = ''
-            id2name[eid] = name
-            id2type[eid] = type
-            id2info[eid] = info
+        rows = clean_kb_lines(read_lines(f), country_codes)
+        next(rows, None)
+        for offset, line in rows:
+            eid, name, type, info = parse_kb_line(line)
+            id2offset.add(eid, offset)
             yield eid, name, name, type, info
-    with open(alias_path, 'r') as f:
-        f.readline()
-        for line in f:
-            eid, name = line.strip().split('\t')
-            if eid in id2type:
-                yield eid, name, id2name[eid], id2type[eid], id2info[eid]
+    id2offset.freeze()
+    entity = None
+    with open(kb_path, 'r') as kb:
+        with open(alias_path, 'r') as f:
+            f.readline()
+            for line in f:
+                eid, name = line.strip().split('\t')
+                if entity is None or entity[0] != eid:
+                    offset = id2offset.get(eid)
+                    if offset is None:
+                        continue
+                    kb.seek(offset)
+                    entity = parse_kb_line(kb.readline())
+                yield eid, name, entity[1], entity[2], entity[3]
 
 
+def kb_documents(kb_path, alias_path, country_codes):
+    # cleaned entities.tab rows and alternate names, plus their unidecoded names
+    for eid, name, cname, type, info in load_id2name(kb_path, alias_path, country_codes):
+        yield eid, name, cname, type, info
+        # --
+        # normed name
+        normed_name = unidecode(name.decode("utf-8"))
+        if normed_name != name:
+            yield eid, normed_name, cname, type, info
+        # --
+
+
+def index_kb(indexer, documents, threads=1, exact_index=None, batch_size=1000):
+    if threads <= 1:
+        for doc in documents:
+            indexer.index(*doc)
+            if exact_index is not None:
+                exact_index.index(*doc)
+        return
+    # IndexWriter is thread-safe and JCC releases the GIL inside Java calls
+    queue = Queue.Queue(threads * 4)
+    errors = []
+    def work():
+        init_lucene()
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            if errors:
+                continue
+            try:
+                for doc in batch:
+                    indexer.index(*doc)
+            except Exception as e:
+                errors.append(e)
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    batch = []
+    for doc in documents:
+        if exact_index is not None:
+            exact_index.index(*doc)
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            queue.put(batch)
+            batch = []
+        if errors:
+            break
+    queue.put(batch)
+    for worker in workers:
+        queue.put(None)
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+
+
+EN_WIKI_PREFIX = "http://en.wikipedia.org/wiki/"
+
+class Candidate(dict):
+    # a KB document, plus what the scorers need from it parsed once
+    __slots__ = ('info_fields', 'lname', 'lcname', 'wiki_entry')
+
+    def __init__(self, fields):
+        dict.__init__(self, fields)
+        self.info_fields = self['info'].split('\t')
+        self.lname = self['name'].lower().encode('utf-8')
+        self.lcname = self['CannonicalName'].lower().encode('utf-8')
+        # lowercased english wikipedia title, if the wiki link column has one
+        self.wiki_entry = None
+        if len(self.info_fields) == 3:
+            wiki_link = self.info_fields[2].encode('utf-8').split("|")[0]  # split if there are too many
+            if wiki_link.startswith(EN_WIKI_PREFIX):
+                self.wiki_entry = wiki_link[len(EN_WIKI_PREFIX):].lower()
+
+# KB types a mention of each type can be linked to, see EntityLinker.score_candidates()
+CANDIDATE_TYPES = {
+    'GPE': ('GPE', 'LOC', 'FAC'),
+    'LOC': ('GPE', 'LOC', 'FAC'),
+    'FAC': ('GPE', 'LOC', 'FAC'),
+    'ORG': ('ORG',),
+    'PER': ('PER',),
+}
+
+# --shard-by-type keeps one index per group of types under lucene_index/<shard>/
+TYPE_SHARDS = {'GPE': 'gpe', 'LOC': 'gpe', 'FAC': 'gpe', 'PER': 'per', 'ORG': 'org'}
+SHARDS = ('gpe', 'per', 'org', 'other')
+
+def type_shard(type):
+    return TYPE_SHARDS.get(type, 'other')
+
+def has_type_shards(indexDir):
+    return any(os.path.isdir(os.path.join(indexDir, shard)) for shard in SHARDS)
+
+# --directory: mmap by default on 64-bit linux JVMs, simple (positional reads under a per-file lock) elsewhere
+DIRECTORY_TYPES = ('mmap', 'nio', 'simple')
+DIRECTORY_TYPE = None
+
+def open_directory(indexDir):
+    directory_type = DIRECTORY_TYPE
+    if directory_type is None:
+        directory_type = 'mmap' if Constants.LINUX and Constants.JRE_IS_64BIT and MMapDirectory.UNMAP_SUPPORTED else 'simple'
+    directory_class = {'mmap': MMapDirectory, 'nio': NIOFSDirectory, 'simple': SimpleFSDirectory}[directory_type]
+    return directory_class(Paths.get(indexDir))
+
+def touch_files(path):
+    # reads path (every file under it for a directory) once, so searches start from a warm page cache
+    if os.path.isfile(path):
+        paths = [path]
+    else:
+        paths = [os.path.join(root, fname) for root, dirs, files in os.walk(path) for fname in files]
+    size = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                size += len(block)
+    return size
+
+def capped_ram_buffer_mb(ram_buffer_mb, writers=1):
+    # the buffers of all writers together get at most half of the JVM heap, the rest is left to merges
+    heap_mb = Runtime.getRuntime().maxMemory() / (1 << 20)
+    cap = max(16, heap_mb // 2 // writers)
+    if ram_buffer_mb > cap:
+        sys.stderr.write("--index-ram-mb: using {} MB per writer, {} MB does not fit a {} MB heap "
+                         "(raise it with --jvm-args -Xmx...)\n".format(cap, ram_buffer_mb, heap_mb))
+        return cap
+    return ram_buffer_mb
+
 class Indexer:
-    def __init__(self, indexDir):
-        self.directory = SimpleFSDirectory(Paths.get(indexDir))
+    def __init__(self, indexDir, ram_buffer_mb=None, writers=1):
+        init_lucene()
+        self.directory = open_directory(indexDir)
         self.analyzer = StandardAnalyzer()
         # analyzer = LimitTokenCountAnalyzer(analyzer, 10000)
         self.config = IndexWriterConfig(self.analyzer)
+        if ram_buffer_mb:
+            # bulk loading: flush large segments, merge wider and skip compound files
+            self.config.setRAMBufferSizeMB(float(capped_ram_buffer_mb(ram_buffer_mb, writers)))
+            self.config.setUseCompoundFile(False)
+            merge_policy = TieredMergePolicy()
+            merge_policy.setMaxMergeAtOnce(30)
+            merge_policy.setSegmentsPerTier(30.0)
+            merge_policy.setNoCFSRatio(0.0)
+            self.config.setMergePolicy(merge_policy)
         self.writer = IndexWriter(self.directory, self.config)
 
     def index(self, eid, name, cname, type, info):
@@ -98,47 +414,362 @@ class Indexer:
         self.writer.addDocument(doc)
         # print eid, name
 
+    def force_merge(self, max_segments=1):
+        self.writer.forceMerge(max_segments)
+
+    def rollback(self):
+        # drops everything added since the last commit and closes the writer
+        self.writer.rollback()
+
     def close(self):
         self.writer.commit()
         self.writer.close()
 
 
+class ShardedIndexer:
+    def __init__(self, indexDir, ram_buffer_mb=None):
+        self.indexDir = indexDir
+        self.ram_buffer_mb = ram_buffer_mb
+        self.indexers = {}
+        self.lock = threading.Lock()
+
+    def index(self, eid, name, cname, type, info):
+        shard = type_shard(type)
+        if shard not in self.indexers:
+            with self.lock:
+                if shard not in self.indexers:
+                    # --index-ram-mb is shared by the shard writers, which are all open at the same time
+                    self.indexers[shard] = Indexer(os.path.join(self.indexDir, shard),
+                                                   self.ram_buffer_mb and max(1, self.ram_buffer_mb // len(SHARDS)),
+                                                   len(SHARDS))
+        self.indexers[shard].index(eid, name, cname, type, info)
+
+    def force_merge(self, max_segments=1):
+        for indexer in self.indexers.values():
+            indexer.force_merge(max_segments)
+
+    def close(self):
+        for indexer in self.indexers.values():
+            indexer.close()
+
+
 class Searcher:
-    def __init__(self, indexDir):
-        self.directory = SimpleFSDirectory(Paths.get(indexDir))
-        self.reader = DirectoryReader.open(self.directory)
+    def __init__(self, indexDir, writer=None):
+        init_lucene()
+        start = time.time()
+        if writer is None:
+            self.directory = open_directory(indexDir)
+            self.reader = DirectoryReader.open(self.directory)
+        else:
+            # near-real-time reader, sees documents the writer has not committed yet
+            self.directory = None
+            self.reader = DirectoryReader.open(writer)
         self.searcher = IndexSearcher(self.reader)
-        self.nameQueryParser = QueryParser('name', StandardAnalyzer())
-        self.nameQueryParser.setDefaultOperator(QueryParser.Operator.AND)
-        self.idQueryParser = QueryParser('id', StandardAnalyzer())
-        self.idQueryParser.setDefaultOperator(QueryParser.Operator.AND)
-
-    def find_by_name(self, name):
-        query = self.nameQueryParser.parse(name)
-        docs = self.searcher.search(query, 100).scoreDocs
-        tables = []
-        for scoreDoc in docs:
-            doc = self.searcher.doc(scoreDoc.doc)
-            table = dict((field.name(), field.stringValue()) for field in doc.getFields())
-            tables.append(table)
-        
-        return tables
+        # the reader, IndexSearcher and analyzer are shared between threads
+        self.analyzer = StandardAnalyzer()
+        if writer is None:
+            startup_times['reader open'] = startup_times.get('reader open', 0.) + time.time() - start
+
+    def analyze(self, field, text):
+        # the tokens the index holds for text: lowercased, without stop words
+        tokens = []
+        stream = self.analyzer.tokenStream(field, text)
+        term = stream.addAttribute(CharTermAttribute.class_)
+        stream.reset()
+        while stream.incrementToken():
+            tokens.append(term.toString())
+        stream.end()
+        stream.close()
+        return tokens
+
+    def all_of(self, clauses):
+        # queries are built directly instead of going through the QueryParser, so mentions
+        # with ':', '(', '/', quotes etc. are searched like any other
+        if len(clauses) == 1:
+            return clauses[0]
+        builder = BooleanQuery.Builder()
+        for clause in clauses:
+            builder.add(clause, BooleanClause.Occur.MUST)
+        return builder.build()
+
+    def find_by_name(self, name, types=None):
+        init_lucene()
+        tokens = self.analyze('name', name)
+        if not tokens:
+            return []
+        return self.search(self.all_of([TermQuery(Term('name', token)) for token in tokens]), types)
+
+    def find_fuzzy(self, name, dist, types=None):
+        # every term within dist edits of some token, the terms are lowercased but not analyzed
+        init_lucene()
+        dist = min(dist, MAX_FUZZY_EDITS)
+        terms = [to_unicode(term).lower() for term in name.split(' ')]
+        # and/or/not are stop words, the analyzer drops them
+        clauses = [FuzzyQuery(Term('name', term), dist) for term in terms if term and term not in _KEY_WORDS]
+        if not clauses:
+            return []
+        return self.search(self.all_of(clauses), types)
+
+    def search(self, query, types=None):
+        start = profiler.start()
+        if types:
+            # 'type' is a one-token text field, so its terms are the lowercased types
+            type_query = BooleanQuery.Builder()
+            for type in types:
+                type_query.add(TermQuery(Term('type', type.lower())), BooleanClause.Occur.SHOULD)
+            builder = BooleanQuery.Builder()
+            builder.add(query, BooleanClause.Occur.MUST)
+            builder.add(type_query.build(), BooleanClause.Occur.FILTER)
+            query = builder.build()
+        results = self.load(self.searcher.search(query, 100).scoreDocs)
+        profiler.stop('search', start)
+        return results
 
     def find_by_id(self, id):
-        query = self.idQueryParser.parse(id)
-        docs = self.searcher.search(query, 100).scoreDocs
+        init_lucene()
+        tokens = self.analyze('id', id)
+        if not tokens:
+            return []
+        query = self.all_of([TermQuery(Term('id', token)) for token in tokens])
+        return self.load(self.searcher.search(query, 100).scoreDocs)
+
+    def warm_up(self):
+        # loads the term dictionaries and runs the fuzzy automaton code once
+        self.find_by_name(u'warmup')
+        self.find_fuzzy(u'warmup', 2)
+
+    def load(self, docs):
         tables = []
         for scoreDoc in docs:
+            # the scorer reads every stored field, 'info' included, so the whole document is loaded
             doc = self.searcher.doc(scoreDoc.doc)
-            table = dict((field.name(), field.stringValue()) for field in doc.getFields())
-            tables.append(table)
-        
+            tables.append(Candidate((field.name(), field.stringValue()) for field in doc.getFields()))
         return tables
 
+    def refresh(self, writer=None):
+        if writer is None:
+            reader = DirectoryReader.openIfChanged(self.reader)
+        else:
+            reader = DirectoryReader.openIfChanged(self.reader, writer)
+        if reader is not None:
+            self.reader.close()
+            self.reader = reader
+            self.searcher = IndexSearcher(self.reader)
+
     def close(self):
-        self.directory.close()
+        if self.directory is not None:
+            self.directory.close()
         self.reader.close()
 
+_NAME_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def to_unicode(text):
+    if isinstance(text, unicode):
+        return text
+    return text.decode('utf-8')
+
+def name_key(name):
+    # roughly what StandardAnalyzer keeps of a name: lowercased word tokens
+    return u' '.join(_NAME_TOKEN_RE.findall(to_unicode(name).lower()))
+
+class ExactNameIndex(object):
+    # normalized name -> KB rows, answers zero-edit lookups without going through the JVM
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA mmap_size=17179869184')
+        # --query-threads share the connection
+        self.lock = threading.Lock()
+        self.conn.execute('CREATE TABLE IF NOT EXISTS names '
+                          '(key TEXT, id TEXT, name TEXT, CannonicalName TEXT, type TEXT, info TEXT)')
+
+    def index(self, eid, name, cname, type, info):
+        self.conn.execute('INSERT INTO names VALUES (?, ?, ?, ?, ?, ?)',
+                          (name_key(name), to_unicode(eid), to_unicode(name),
+                           to_unicode(cname), to_unicode(type), to_unicode(info)))
+
+    def close(self):
+        self.conn.execute('CREATE INDEX IF NOT EXISTS names_key ON names (key)')
+        self.conn.commit()
+        self.conn.close()
+
+    def find_by_name(self, name, types=None):
+        sql = 'SELECT id, name, CannonicalName, type, info FROM names WHERE key = ?'
+        params = [name_key(name)]
+        if types:
+            sql += ' AND type IN ({})'.format(', '.join('?' for _ in types))
+            params.extend(types)
+        with self.lock:
+            rows = self.conn.execute(sql + ' ORDER BY rowid', params).fetchall()
+        return [Candidate({'id': eid, 'name': ename, 'CannonicalName': cname, 'type': etype, 'info': info})
+                for eid, ename, cname, etype, info in rows]
+
+# --
+# --backend sqlite: the searches of Searcher over an FTS5 table in one sqlite file, no JVM needed
+BACKENDS = ('lucene', 'sqlite')
+
+# StandardAnalyzer's stop words in Lucene 7, exact queries ignore them
+STOP_WORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is',
+                        'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the', 'their', 'then', 'there',
+                        'these', 'they', 'this', 'to', 'was', 'will', 'with'])
+
+# FuzzyQuery's default maxExpansions: a fuzzy term is searched as its 50 closest index terms
+MAX_FUZZY_EXPANSIONS = 50
+
+def trigrams(term):
+    # padded, so the first and last letters are in trigrams of their own
+    padded = u'\x01\x01' + term + u'\x01\x01'
+    return set(padded[i:i+3] for i in range(len(padded) - 2))
+
+def fts_phrase(token):
+    return u'"' + token.replace(u'"', u'""') + u'"'
+
+class SqliteIndexer(object):
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA synchronous=OFF')
+        # explicit row ids, VACUUM would renumber implicit ones under the full text index
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entities '
+                          '(docid INTEGER PRIMARY KEY, id TEXT, name TEXT, CannonicalName TEXT, type TEXT, info TEXT)')
+        self.optimize = False
+
+    def index(self, eid, name, cname, type, info):
+        self.conn.execute('INSERT INTO entities (id, name, CannonicalName, type, info) VALUES (?, ?, ?, ?, ?)',
+                          (to_unicode(eid), to_unicode(name), to_unicode(cname), to_unicode(type), to_unicode(info)))
+
+    def force_merge(self, max_segments=1):
+        # the full text index is only built in close()
+        self.optimize = True
+
+    def close(self):
+        conn = self.conn
+        conn.execute('CREATE INDEX IF NOT EXISTS entities_id ON entities (id)')
+        # no case folding beyond lowercasing, like StandardAnalyzer
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5(name, content='entities', "
+                     "content_rowid='docid', tokenize='unicode61 remove_diacritics 0')")
+        conn.execute("INSERT INTO names(names) VALUES ('rebuild')")
+        if self.optimize:
+            conn.execute("INSERT INTO names(names) VALUES ('optimize')")
+        # every index term with its trigrams, fuzzy terms are looked up through the trigrams they share
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS names_vocab USING fts5vocab(names, 'row')")
+        conn.execute('DROP TABLE IF EXISTS grams')
+        conn.execute('DROP TABLE IF EXISTS terms')
+        conn.execute('CREATE TABLE terms (term_id INTEGER PRIMARY KEY, term TEXT, length INTEGER)')
+        conn.execute('CREATE TABLE grams (gram TEXT, term_id INTEGER, PRIMARY KEY (gram, term_id)) WITHOUT ROWID')
+        for term_id, (term,) in enumerate(conn.execute('SELECT term FROM names_vocab').fetchall()):
+            conn.execute('INSERT INTO terms VALUES (?, ?, ?)', (term_id, term, len(term)))
+            conn.executemany('INSERT INTO grams VALUES (?, ?)', [(gram, term_id) for gram in trigrams(term)])
+        conn.commit()
+        if self.optimize:
+            conn.execute('VACUUM')
+        conn.close()
+
+
+class SqliteSearcher(object):
+    def __init__(self, path):
+        start = time.time()
+        self.path = path
+        if not os.path.isfile(path):
+            raise IOError('no sqlite index ' + path)
+        # one connection per thread, sqlite releases the GIL while it searches
+        self.local = threading.local()
+        self.conns = []
+        self.conn()
+        startup_times['reader open'] = startup_times.get('reader open', 0.) + time.time() - start
+
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA mmap_size=17179869184')
+            self.conns.append(conn)
+        return conn
+
+    def find_by_name(self, name, types=None):
+        # all tokens of name, as Searcher.find_by_name searches it
+        start = profiler.start()
+        results = self.match([[token] for token in name_key(name).split() if token not in STOP_WORDS], types)
+        profiler.stop('search', start)
+        return results
+
+    def find_fuzzy(self, name, dist, types=None):
+        # every term of name within dist edits of some token, as Searcher.find_fuzzy searches it
+        start = profiler.start()
+        dist = min(dist, MAX_FUZZY_EDITS)
+        terms = [term for term in to_unicode(name).lower().split(' ') if term and term not in _KEY_WORDS]
+        results = self.match([self.expand(term, dist) for term in terms], types)
+        profiler.stop('search', start)
+        return results
+
+    def expand(self, term, dist):
+        # the index terms within dist edits of term, closest first
+        grams = trigrams(term)
+        # an edit changes at most 3 of the trigrams, a transposition 4; below that bound candidates have to
+        # share one, so unlike FuzzyQuery 'xy~2' does not find 'ab'
+        min_shared = max(len(grams) - 4 * dist, 1)
+        rows = self.conn().execute(
+            'SELECT t.term FROM grams g JOIN terms t ON t.term_id = g.term_id '
+            'WHERE g.gram IN ({}) AND t.length BETWEEN ? AND ? '
+            'GROUP BY g.term_id HAVING COUNT(*) >= ?'.format(', '.join('?' for _ in grams)),
+            list(grams) + [len(term) - dist, len(term) + dist, min_shared]).fetchall()
+        matches = sorted((edit_distance(term, candidate, dist), candidate) for (candidate,) in rows)
+        return [candidate for d, candidate in matches if d <= dist][:MAX_FUZZY_EXPANSIONS]
+
+    def match(self, groups, types=None):
+        # groups: per query term the index terms that satisfy it, each group has to match
+        if not groups or not all(groups):
+            return []
+        query = u' AND '.join(u'(' + u' OR '.join(fts_phrase(token) for token in group) + u')' for group in groups)
+        sql = ('SELECT e.id, e.name, e.CannonicalName, e.type, e.info FROM names '
+               'JOIN entities e ON e.docid = names.rowid WHERE names MATCH ?')
+        params = [query]
+        if types:
+            sql += ' AND e.type IN ({})'.format(', '.join('?' for _ in types))
+            params.extend(types)
+        rows = self.conn().execute(sql + ' ORDER BY bm25(names) LIMIT 100', params).fetchall()
+        return [Candidate({'id': eid, 'name': ename, 'CannonicalName': cname, 'type': etype, 'info': info})
+                for eid, ename, cname, etype, info in rows]
+
+    def find_by_id(self, id):
+        rows = self.conn().execute('SELECT id, name, CannonicalName, type, info FROM entities WHERE id = ? '
+                                   'LIMIT 100', (to_unicode(id),)).fetchall()
+        return [Candidate({'id': eid, 'name': ename, 'CannonicalName': cname, 'type': etype, 'info': info})
+                for eid, ename, cname, etype, info in rows]
+
+    def warm_up(self):
+        self.find_by_name(u'warmup')
+        self.find_fuzzy(u'warmup', 2)
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+        self.conns = []
+# --
+
+# Lucene's FuzzyQuery (LevenshteinAutomata) supports at most 2 edits, farther searches are cut to 2
+MAX_FUZZY_EDITS = 2
+
+# note: strange problem with key words and/or/not, ignore them!!
+_KEY_WORDS = {"and", "or", "not"}
+
+def edit_distance(str1, str2, limit):
+    # optimal string alignment distance (FuzzyQuery counts transpositions as one edit),
+    # anything above limit is reported as limit + 1
+    if abs(len(str1) - len(str2)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = range(len(str2) + 1)
+    for i in range(1, len(str1) + 1):
+        cur = [i] + [0] * len(str2)
+        for j in range(1, len(str2) + 1):
+            cost = 0 if str1[i-1] == str2[j-1] else 1
+            cur[j] = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + cost)
+            if i > 1 and j > 1 and str1[i-1] == str2[j-2] and str1[i-2] == str2[j-1]:
+                cur[j] = min(cur[j], prev2[j-2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return min(prev[-1], limit + 1)
+
 def iou(str1, str2):
     tokens1 = set(str1.split())
     tokens2 = set(str2.split())
@@ -146,26 +777,265 @@ def iou(str1, str2):
         return 0
     return float(len(tokens1 & tokens2)) / len(tokens1 | tokens2)
 
+def copy_results(results):
+    # linking results are handed out to callers which edit 'confidence' in place
+    if results == 'none':
+        return results
+    return [dict(result) for result in results]
+
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        if key in self.entries:
+            self.entries.pop(key)
+        elif len(self.entries) >= self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self.entries[key] = value
+
+    def stats(self):
+        return 'hits={} misses={} evictions={} size={}/{}'.format(
+            self.hits, self.misses, self.evictions, len(self.entries), self.max_size)
+
+def index_version(index_dir):
+    # every commit writes a new segments_N file, so a rebuilt index gets a new stamp
+    stamp = hashlib.md5()
+    if os.path.isfile(index_dir):
+        # --backend sqlite
+        stamp.update('{}\t{}\n'.format(os.path.getsize(index_dir), os.path.getmtime(index_dir)))
+        return stamp.hexdigest()
+    for root, dirs, files in sorted(os.walk(index_dir)):
+        for fname in sorted(files):
+            if fname.startswith('segments'):
+                path = os.path.join(root, fname)
+                stamp.update('{}\t{}\t{}\n'.format(os.path.relpath(path, index_dir),
+                                                   os.path.getsize(path), os.path.getmtime(path)))
+    return stamp.hexdigest()
+
+class PersistentCache(object):
+    # several runs can share one cache: puts are kept in memory and written in short transactions,
+    # so no write lock is held between flushes
+    def __init__(self, cache_path, version, commit_every=100, commit_seconds=5.):
+        self.version = version
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.pending = {}
+        self.pending_since = None
+        self.hits = 0
+        self.misses = 0
+        # autocommit, flush() opens its own transactions
+        self.conn = sqlite3.connect(cache_path, timeout=600, isolation_level=None)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results '
+                          '(key TEXT PRIMARY KEY, version TEXT, results TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_version ON results (version)')
+        # drop everything computed against an older lucene_index/, only takes the write lock if there is any
+        if self.conn.execute('SELECT 1 FROM results WHERE version != ? LIMIT 1', (self.version,)).fetchone():
+            self.write('DELETE FROM results WHERE version != ?', [(self.version,)])
+
+    def write(self, sql, rows):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany(sql, rows)
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def get(self, key):
+        if key in self.pending:
+            self.hits += 1
+            return json.loads(self.pending[key])
+        row = self.conn.execute('SELECT results FROM results WHERE key = ? AND version = ?',
+                                (key, self.version)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, results):
+        if not self.pending:
+            self.pending_since = time.time()
+        self.pending[key] = json.dumps(results)
+        if len(self.pending) >= self.commit_every or time.time() - self.pending_since >= self.commit_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.write('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                       [(key, self.version, results) for key, results in self.pending.iteritems()])
+            self.pending = {}
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def stats(self):
+        return 'hits={} misses={}'.format(self.hits, self.misses)
+
 class EntityLinker(object):
-    def __init__(self, lucene_index_dir, country_codes):
-        self.lucene_index_dir = lucene_index_dir
-        self.searcher = Searcher(self.lucene_index_dir)
+    def __init__(self, index_path, country_codes, cache_size=0, cache_path=None, exact_index_path=None,
+                 warm_up=False, query_threads=1, backend='lucene'):
+        # index_path is lucene_index/ or, for backend 'sqlite', the file built by --index --backend sqlite
+        self.index_path = index_path
+        self.backend = backend
+        # searchers are opened on first use, answers from the caches or the exact index need no JVM
+        self.searcher = None
+        self.shards = {}
+        self.sharded = False
+        if self.backend == 'sqlite':
+            if not os.path.isfile(self.index_path):
+                raise IOError('no sqlite index ' + self.index_path)
+        else:
+            self.sharded = has_type_shards(self.index_path)
+            if not self.sharded and not any(f.startswith('segments') for f in os.listdir(self.index_path)):
+                raise IOError('no Lucene index in ' + self.index_path)
+        self.open_lock = threading.Lock()
         self.country_codes = country_codes
+        self.exact_index = None
+        if exact_index_path and os.path.exists(exact_index_path):
+            self.exact_index = ExactNameIndex(exact_index_path)
+        self.cache = LRUCache(cache_size)
+        self.disk_cache = None
+        if cache_path:
+            version = index_version(self.index_path)
+            if self.exact_index is not None:
+                version += '+exact'
+            self.disk_cache = PersistentCache(cache_path, version)
+        # results computed ahead of time by --workers processes, keyed on the exact query
+        self.prefetched = {}
+        self.pool = None
+        if query_threads > 1:
+            # threads attach to the JVM in Searcher.find_by_name
+            self.pool = ThreadPool(query_threads)
+        if warm_up:
+            self.warm_up(exact_index_path)
+
+    def warm_up(self, exact_index_path=None):
+        start = time.time()
+        size = touch_files(self.index_path)
+        if self.exact_index is not None:
+            size += touch_files(exact_index_path)
+        for searcher in self.open_searchers():
+            searcher.warm_up()
+        sys.stderr.write("warmed up {:.0f} MB of index in {:.1f}s\n".format(size / 1e6, time.time() - start))
 
-    def search_candidates(self, name, dist=0):
+    def open_searchers(self):
+        if not self.sharded:
+            return [self.get_searcher(None)]
+        searchers = [self.get_searcher([type]) for type in ('GPE', 'PER', 'ORG', 'other')]
+        return [searcher for searcher in searchers if searcher is not None]
+
+    def get_searcher(self, types):
+        if not self.sharded:
+            if self.searcher is None:
+                with self.open_lock:
+                    if self.searcher is None:
+                        if self.backend == 'sqlite':
+                            self.searcher = SqliteSearcher(self.index_path)
+                        else:
+                            self.searcher = Searcher(self.index_path)
+            return self.searcher
+        # all types of one CANDIDATE_TYPES group live in the same shard
+        shard = type_shard(types[0])
+        if shard not in self.shards:
+            with self.open_lock:
+                if shard not in self.shards:
+                    shard_dir = os.path.join(self.index_path, shard)
+                    self.shards[shard] = Searcher(shard_dir) if os.path.isdir(shard_dir) else None
+        return self.shards[shard]
+
+    def search_candidates(self, name, dist=0, types=None):
+        # searchers of either backend answer find_by_name, find_fuzzy and find_by_id
+        if dist == 0 and self.exact_index is not None:
+            candidates = self.exact_index.find_by_name(name, types)
+            if candidates:
+                return candidates
+        searcher = self.get_searcher(types)
+        if searcher is None:
+            return []
         if dist == 0:
-            return self.searcher.find_by_name(name)
-        else:
-            terms = name.split(' ')
-            # --
-            # note: strange problem with key words and/or/not, ignore them!!
-            _KEY_WORDS = {"and", "or", "not"}
-            query = ' '.join([('{}~{}'.format(term, dist) if term.lower() not in _KEY_WORDS else term) for term in terms])
-            # --
-            # print(query)
-            return self.searcher.find_by_name(query)
+            return searcher.find_by_name(name, types)
+        return searcher.find_fuzzy(name, dist, types)
         
+    def search(self, search):
+        # search is (name, dist, ent_type), None if the search failed
+        name, dist, ent_type = search
+        start = profiler.start()
+        try:
+            candidates = self.search_candidates(name, dist, CANDIDATE_TYPES[ent_type])
+        except:
+            return None
+        if dist > 0:
+            profiler.stop('fuzzy', start)
+        return candidates
+
+    def map_searches(self, searches):
+        # Lucene and sqlite release the GIL while they search, so --query-threads run the searches of a batch in parallel
+        if self.pool is None or len(searches) < 2:
+            return [self.search(search) for search in searches]
+        return self.pool.map(self.search, searches)
+
+    def group_by_edit_distance(self, candidates, ent_name, dist):
+        # splits the hits of one 'term~dist' search into what 'term~1', ..., 'term~dist'
+        # would have matched, keeping the Lucene ranking inside each group
+        # ent_name is lowercased utf-8, only its ascii letters; the candidate tokens are lowercased unicode
+        terms = [to_unicode(term).lower() for term in ent_name.split(' ') if term and term.lower() not in _KEY_WORDS]
+        distances = []
+        for candidate in candidates:
+            tokens = name_key(candidate['name']).split()
+            candidate_dist = 0
+            for term in terms:
+                term_dist = min([edit_distance(term, token, dist) for token in tokens] or [dist])
+                candidate_dist = max(candidate_dist, term_dist)
+            # tokenization differs a bit from StandardAnalyzer, lucene matched it within dist anyway
+            distances.append(min(candidate_dist, dist))
+        groups = []
+        for d in range(1, dist + 1):
+            groups.append([candidate for candidate, candidate_dist in zip(candidates, distances)
+                           if candidate_dist <= d])
+        return groups
+
     def score_candidates(self, candidates, ent_name, ent_type):
+        start = profiler.start()
+        candidates = self.candidates_of_type(candidates, ent_type)
+        if candidates is None or len(candidates) == 0:
+            profiler.stop('score', start)
+            return None
+        if len(candidates) == 1:
+            profiler.stop('score', start)
+            return candidates
+
+        scores = []
+        for candidate in candidates:
+            score = 0
+            for addend in self.candidate_features(candidate, ent_name, ent_type):
+                score += addend
+            scores.append(score)
+        max_score = max(scores)
+        profiler.stop('score', start)
+        return [candidate for candidate, score in zip(candidates, scores) if score == max_score]
+
+    def candidates_of_type(self, candidates, ent_type):
         # filter by type
         if ent_type == 'GPE' or ent_type == 'LOC' or ent_type == 'FAC':
             candidates = filter(lambda x: x['type'] in ['GPE', 'LOC', 'FAC'], candidates)
@@ -184,65 +1054,49 @@ class EntityLinker(object):
                 continue
             candidate_ids.add(candidate['id'])
             filtered_candidates.append(candidate)
-        candidates = filtered_candidates
-        if len(candidates) == 1:
-            return candidates
+        return filtered_candidates
 
-        scores = [0 for _ in candidates]
+    def candidate_features(self, candidate, ent_name, ent_type):
+        # the score of a candidate is the sum of these, in this order
         # find exact match
-        for i, candidate in enumerate(candidates):
-            # print candidate['name'].lower(), ent_name
-            for _key in ['name', 'CannonicalName']:
-                if candidate[_key].lower().encode('utf-8') == ent_name:
-                    scores[i] += 1
-                elif ent_name in candidate[_key].lower().encode('utf-8'):
-                    scores[i] += 0.5
+        name_match = [0, 0]
+        for k, lname in enumerate((candidate.lname, candidate.lcname)):
+            if lname == ent_name:
+                name_match[k] = 1
+            elif ent_name in lname:
+                name_match[k] = 0.5
 
         # filter by type
-        for i, candidate in enumerate(candidates):
-            if candidate['type'] == ent_type:
-                scores[i] += 1
+        type_match = 1 if candidate['type'] == ent_type else 0
 
         # filter by wiki
-        for i, candidate in enumerate(candidates):
-            if candidate['info'] == '': continue
-            if len(candidate['info'].split('\t')) == 3: # candidate['info'].split('\t')[2] != '':
-                scores[i] += 1
-                # --
-                # further check wiki link
-                _wiki_link = candidate['info'].split('\t')[2].encode('utf-8')
-                _wiki_link = _wiki_link.split("|")[0]  # split if there are too many
-                if _wiki_link.startswith("http://en.wikipedia.org/wiki/"):
-                    wiki_entry = _wiki_link[len("http://en.wikipedia.org/wiki/"):]
-                    if wiki_entry.lower() == ent_name:
-                        scores[i] += 1  # directly hit
-                    else:  # prefer shorter entry!
-                        scores[i] += 0.5 * len(ent_name)/len(wiki_entry)
-                # --
+        has_wiki, wiki_match = 0, 0
+        if candidate['info'] != '' and len(candidate.info_fields) == 3:
+            has_wiki = 1
+            # --
+            # further check wiki link
+            wiki_entry = candidate.wiki_entry
+            if wiki_entry is not None:
+                if wiki_entry == ent_name:
+                    wiki_match = 1  # directly hit
+                else:  # prefer shorter entry!
+                    wiki_match = 0.5 * len(ent_name)/len(wiki_entry)
+            # --
 
         # filter by country
-        if ent_type == 'GPE' or ent_type == 'LOC':
-            for i, candidate in enumerate(candidates):
-                if candidate['info'] == '': continue
-                if candidate['info'].split('\t')[1] == 'country,state,region,...':
-                    scores[i] += 1
-                if candidate['info'].split('\t')[1] == 'city,village,...':
-                    scores[i] += 0.5
-                if candidate['info'].split('\t')[0] in self.country_codes:
-                    scores[i] += 1
-                if candidate['info'].split('\t')[0] == 'US' or candidate['info'].split('\t')[0] == 'CA':
-                    scores[i] -= 0.5
-
-        max_score = -1
-        final_candidates = None
-        for candidate, score in zip(candidates, scores):
-            if score > max_score:
-                max_score = score
-                final_candidates = [candidate]
-            elif score == max_score:
-                final_candidates.append(candidate)
-        # print candidates, scores
-        return final_candidates
+        country = [0, 0, 0, 0]
+        if (ent_type == 'GPE' or ent_type == 'LOC') and candidate['info'] != '':
+            info_fields = candidate.info_fields
+            if info_fields[1] == 'country,state,region,...':
+                country[0] = 1
+            if info_fields[1] == 'city,village,...':
+                country[1] = 0.5
+            if info_fields[0] in self.country_codes:
+                country[2] = 1
+            if info_fields[0] == 'US' or info_fields[0] == 'CA':
+                country[3] = -0.5
+
+        return [name_match[0], name_match[1], type_match, has_wiki, wiki_match] + country
 
     def filter_candidates(self, candidates, ent_name, ent_type):
         # filter by type
@@ -267,7 +1121,7 @@ class EntityLinker(object):
             return candidates
 
         # find exact match
-        filtered = filter(lambda x: x['name'].lower() == ent_name, candidates)
+        filtered = filter(lambda x: x.lname == ent_name, candidates)
         if len(filtered) == 1:
             return filtered
         elif len(filtered) == 0:
@@ -285,7 +1139,7 @@ class EntityLinker(object):
             candidates = filtered
 
         # filter by wiki
-        filtered = filter(lambda x: x['info'].split('\t')[2] != '', candidates)
+        filtered = filter(lambda x: x.info_fields[2] != '', candidates)
         if len(filtered) == 1:
             return filtered
         elif len(filtered) == 0:
@@ -295,7 +1149,7 @@ class EntityLinker(object):
 
         # filter by country
         filtered = filter(lambda x: x['type'] != 'GPE' and x['type'] != 'LOC' or 
-            x['info'].split('\t')[1] == 'country,state,region,...', candidates)
+            x.info_fields[1] == 'country,state,region,...', candidates)
         if len(filtered) == 1:
             return filtered
         elif len(filtered) == 0:
@@ -303,7 +1157,7 @@ class EntityLinker(object):
         else:
             candidates = filtered
         filtered = filter(lambda x: x['type'] != 'GPE' and x['type'] != 'LOC' or 
-                          len(self.country_codes) == 0 or x['info'].split('\t')[0] in self.country_codes, candidates)
+                          len(self.country_codes) == 0 or x.info_fields[0] in self.country_codes, candidates)
         if len(filtered) == 1:
             return filtered
         elif len(filtered) == 0:
@@ -314,112 +1168,304 @@ class EntityLinker(object):
         return candidates
 
     def disamb(self, candidates, ent_name, ent_type, sentence):
-        # print 'disamb:', candidates
-        edit_score = [1./(abs(len(candidate['name']) - len(ent_name)) + 1) for candidate in candidates]
-        context_score = [0 for _ in range(len(candidates))]
-        if ent_type == 'PER':
-            for c, candidate in enumerate(candidates):
+        start = profiler.start()
+        scores = []
+        for candidate in candidates:
+            context = 0
+            if ent_type == 'PER':
                 info = candidate['info']
-                context_score[c] = iou(info, sentence) * 5
+                context = iou(info, sentence) * 5
                 # TODO: fix this, this shouldn't be hardcoded
                 #  if 'Russia' in info or 'Ukraine' in info:
                 if 'Venezuela' in info:
-                    context_score[c] += 1
-        elif ent_type == 'ORG':
-            for c, candidate in enumerate(candidates):
+                    context += 1
+            elif ent_type == 'ORG':
                 info = candidate['info']
-                context_score[c] = iou(info, sentence) * 5
-        
-        scores = [0 for _ in range(len(candidates))]
-        for i in range(len(candidates)):
-            scores[i] = edit_score[i] + context_score[i]
-        # print scores
+                context = iou(info, sentence) * 5
+            scores.append(1./(abs(len(candidate['name']) - len(ent_name)) + 1) + context)
+
         score_sum = sum(scores)
-        for i in range(len(candidates)):
-            candidates[i]['confidence'] = scores[i] / score_sum
+        for candidate, score in zip(candidates, scores):
+            candidate['confidence'] = score / score_sum
         candidates.sort(key=lambda x: -x['confidence'])
+        profiler.stop('disamb', start)
         return candidates
 
+    def cache_key(self, ne, sentence):
+        ent_type = ne['type'][7:10]
+        # the sentence only matters when disamb() scores the context (PER/ORG)
+        context = ''
+        if ent_type in ('PER', 'ORG') and sentence:
+            if isinstance(sentence, unicode):
+                sentence = sentence.encode('utf-8')
+            context = hashlib.md5(sentence).hexdigest()
+        return ne['mention'].lower(), ent_type, context
+
+    def disk_cache_key(self, key):
+        return json.dumps(list(key) + [sorted(self.country_codes)])
+
+    def query(self, ne, sentence):
+        return self.query_batch([(ne, sentence)])[0]
+
+    def query_batch(self, mentions):
+        # links (ne, sentence) pairs, identical mentions are only searched once
+        results = [None for _ in mentions]
+        use_cache = self.cache.max_size > 0 or self.disk_cache is not None
+        pending = OrderedDict()
+        for i, (ne, sentence) in enumerate(mentions):
+            if self.prefetched:
+                prefetched = self.prefetched.get((ne['mention'], ne['type'], sentence))
+                if prefetched is not None:
+                    results[i] = copy_results(prefetched)
+                    continue
+            key = self.cache_key(ne, sentence)
+            if key in pending:
+                pending[key].append(i)
+                continue
+            if use_cache:
+                cached = self.cached(key)
+                if cached is not None:
+                    results[i] = copy_results(cached)
+                    continue
+            pending[key] = [i]
+        if not pending:
+            return results
+
+        linked = self._query_with_fallback_batch([mentions[indices[0]] for indices in pending.values()])
+        for (key, indices), result in zip(pending.items(), linked):
+            if use_cache:
+                self.store(key, result)
+            for n, i in enumerate(indices):
+                results[i] = result if n == 0 else copy_results(result)
+        return results
+
+    def prefetch(self, queries):
+        # links the (ne, sentence, fringe ne) triples of csr_linker_queries() in two batches,
+        # the result is meant for self.prefetched
+        queries = list(queries)
+        mentions = [(ne, sent) for ne, sent, fne in queries]
+        results = self.query_batch(mentions)
+        fringes = [(fne, sent) for (ne, sent, fne), result in zip(queries, results)
+                   if fne is not None and result != 'none']
+        results += self.query_batch(fringes)
+        prefetched = {}
+        for (ne, sent), result in zip(mentions + fringes, results):
+            prefetched[(ne['mention'], ne['type'], sent)] = copy_results(result)
+        return prefetched
+
+    def cached(self, key):
+        results = self.cache.get(key)
+        if results is None and self.disk_cache is not None:
+            results = self.disk_cache.get(self.disk_cache_key(key))
+            if results is not None:
+                self.cache.put(key, results)
+        return results
+
+    def store(self, key, results):
+        cached = copy_results(results)
+        self.cache.put(key, cached)
+        if self.disk_cache is not None:
+            self.disk_cache.put(self.disk_cache_key(key), cached)
+
+    def flush(self):
+        if self.disk_cache is not None:
+            self.disk_cache.flush()
+
+    def cache_stats(self):
+        stats = 'memory {}'.format(self.cache.stats())
+        if self.disk_cache is not None:
+            stats += ', disk {}'.format(self.disk_cache.stats())
+        return stats
+
     # --
     # fall back to normalized version!!
-    def query(self, ne, sentence):
-        results = self._query(ne, sentence)
-        if results == 'none':
-            ne2 = ne.copy()
-            ne2['mention'] = unidecode(ne2['mention'].decode("utf-8"))
-            if ne2['mention'] != ne['mention']:
-                results = self._query(ne2, sentence)
+    def _query_with_fallback_batch(self, mentions):
+        results = self._query_batch(mentions)
+        fallback = []
+        for i, (ne, sentence) in enumerate(mentions):
+            if results[i] == 'none':
+                ne2 = ne.copy()
+                ne2['mention'] = unidecode(ne2['mention'].decode("utf-8"))
+                if ne2['mention'] != ne['mention']:
+                    fallback.append((i, (ne2, sentence)))
+        if fallback:
+            profiler.count('unidecode_fallback', len(fallback))
+            for (i, mention), result in zip(fallback, self._query_batch([mention for i, mention in fallback])):
+                results[i] = result
+                if result != 'none':
+                    profiler.count('unidecode_linked')
         return results
     # --
 
-    def _query(self, ne, sentence):
-        ent_name, ent_type = ne['mention'].lower(), ne['type'][7:10]
-        # print(ent_name, ent_type)
-        try:
-            candidates = self.search_candidates(ent_name, 0)
-        except:
-            return 'none'
-        # print candidates
-        candidates = self.score_candidates(candidates, ent_name, ent_type)
-        # print candidates
-        if candidates is None or len(candidates) == 0:
-            for dist in range(min(5, len(ent_name)//5)):
-                try:
-                    candidates = self.search_candidates(ent_name, dist+1)
-                except:
-                    return 'none'
-                # print candidates
-                candidates = self.score_candidates(candidates, ent_name, ent_type)
-                # print candidates
+    def _query_batch(self, mentions):
+        # every stage runs over all mentions before the next one starts
+        results = ['none' for _ in mentions]
+        queries = []
+        for i, (ne, sentence) in enumerate(mentions):
+            ent_name, ent_type = ne['mention'].lower(), ne['type'][7:10]
+            # score_candidates() rejects every candidate for other types
+            if ent_type in CANDIDATE_TYPES:
+                queries.append((i, ent_name, ent_type, sentence))
+
+        searched = []
+        for query, candidates in zip(queries, self.map_searches([(query[1], 0, query[2]) for query in queries])):
+            if candidates is None:
+                continue
+            searched.append((query, candidates))
+        scored = [self.score_candidates(candidates, query[1], query[2]) for query, candidates in searched]
+
+        found = []
+        fuzzy = []
+        for (query, _), candidates in zip(searched, scored):
+            if candidates is not None and len(candidates) > 0:
+                found.append((query, candidates))
+                continue
+            max_dist = min(5, len(query[1])//5, MAX_FUZZY_EDITS)
+            if max_dist == 0:
+                continue
+            # one fuzzy search at the largest distance instead of one search per distance
+            fuzzy.append((query, max_dist))
+        remaining = []
+        for (query, max_dist), fuzzy_candidates in zip(fuzzy, self.map_searches([(query[1], max_dist, query[2])
+                                                                                 for query, max_dist in fuzzy])):
+            if fuzzy_candidates is None:
+                continue
+            start = profiler.start()
+            remaining.append((query, self.group_by_edit_distance(fuzzy_candidates, query[1], max_dist)))
+            profiler.stop('fuzzy.group', start)
+
+        level = 0
+        while remaining:
+            current = [(query, groups) for query, groups in remaining if level < len(groups)]
+            scored = [self.score_candidates(groups[level], query[1], query[2]) for query, groups in current]
+            remaining = []
+            for (query, groups), candidates in zip(current, scored):
                 if candidates is not None and len(candidates) > 0:
-                    break
-        
-        if candidates is None or len(candidates) == 0:
-            return 'none'
-        if len(candidates) == 1:
-            candidates[0]['confidence'] = 1.0
-            return candidates
-        return self.disamb(candidates, ent_name, ent_type, sentence)
+                    found.append((query, candidates))
+                else:
+                    remaining.append((query, groups))
+            level += 1
+
+        for query, candidates in found:
+            if len(candidates) == 1:
+                candidates[0]['confidence'] = 1.0
+                results[query[0]] = candidates
+            else:
+                results[query[0]] = self.disamb(candidates, query[1], query[2], query[3])
+        return results
 
 class TemporaryKB(object):
     def __init__(self, tmp_index_dir):
         self.tmp_index_dir = tmp_index_dir
         self.counts_file = os.path.join(self.tmp_index_dir, 'count.txt')
-        if os.path.isdir(self.tmp_index_dir):
+        self.lock_file = os.path.join(self.tmp_index_dir, 'register.lock')
+        self.lock = None
+        self.indexer = None
+        self.searcher = None
+        self.dirty = False
+        if not os.path.isdir(self.tmp_index_dir):
+            try:
+                os.mkdir(self.tmp_index_dir)
+            except OSError:
+                if not os.path.isdir(self.tmp_index_dir):
+                    raise
+        self.acquire()
+        if os.path.exists(self.counts_file):
             with open(self.counts_file, 'r') as f:
                 self.count = int(f.readline().strip())
-            # self.indexer = Indexer(self.tmp_index_dir)
-            # self.searcher = Searcher(self.tmp_index_dir)
+            self.release()
         else:
-            os.mkdir(self.tmp_index_dir)
             self.count = 0
-            with open(self.counts_file, 'w') as f:
-                f.write('{}'.format(self.count))
-            # self.indexer = Indexer(self.tmp_index_dir)
+            self.indexer = Indexer(self.tmp_index_dir)
             self.register('MH17', 'VEH')
             self.register('T-34', 'VEH')
-            # self.searcher = Searcher(self.tmp_index_dir)
+            self.commit()
+
+    def acquire(self):
+        # serializes tmp_index/ writers and @N id allocation between processes
+        self.lock = open(self.lock_file, 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+        self.lock = None
 
     def register(self, name, type):
         print 'registering:', name, type
-        indexer = Indexer(self.tmp_index_dir)
-        indexer.index('@{}'.format(self.count), name, name, type, '')
+        start = profiler.start()
+        if self.indexer is None:
+            # the writer and the lock are held until the next commit()
+            self.acquire()
+            with open(self.counts_file, 'r') as f:
+                self.count = int(f.readline().strip())
+            self.indexer = Indexer(self.tmp_index_dir)
+        self.indexer.index('@{}'.format(self.count), name, name, type, '')
         self.count += 1
-        with open(self.counts_file, 'w') as f:
-            f.write('{}'.format(self.count))
-        indexer.close()
-        # print '$$', self.searcher.find_by_name(name)
+        self.dirty = True
+        profiler.stop('tmpkb.register', start)
         return '@{}'.format(self.count-1)
 
+    def commit(self):
+        # called at document boundaries
+        if self.indexer is not None:
+            self.indexer.close()
+            self.indexer = None
+            with open(self.counts_file, 'w') as f:
+                f.write('{}'.format(self.count))
+            self.release()
+            # the NRT reader belongs to the closed writer
+            if self.searcher is not None:
+                self.searcher.close()
+                self.searcher = None
+            self.dirty = False
+        elif self.searcher is not None:
+            # pick up entities registered by other processes
+            self.searcher.refresh()
+
+    def rollback(self):
+        # called when a document fails: forget what it registered and let other writers in again
+        if self.indexer is not None:
+            self.indexer.rollback()
+            self.indexer = None
+            self.release()
+            # the NRT reader may have seen the dropped entities
+            if self.searcher is not None:
+                self.searcher.close()
+                self.searcher = None
+            self.dirty = False
+
+    def close(self):
+        self.commit()
+        if self.searcher is not None:
+            self.searcher.close()
+            self.searcher = None
+
+    def get_searcher(self):
+        if self.indexer is not None and self.dirty:
+            if self.searcher is not None and self.searcher.directory is None:
+                self.searcher.refresh(self.indexer.writer)
+            else:
+                if self.searcher is not None:
+                    self.searcher.close()
+                self.searcher = Searcher(self.tmp_index_dir, self.indexer.writer)
+            self.dirty = False
+        elif self.searcher is None:
+            self.searcher = Searcher(self.tmp_index_dir)
+        return self.searcher
+
     # --
     # fall back to normalized version!!
     def query(self, ne):
+        start = profiler.start()
         results = self._query(ne)
         if results == 'none':
             ne2 = ne.copy()
             ne2['mention'] = unidecode(ne2['mention'].decode("utf-8"))
             if ne2['mention'] != ne['mention']:
+                profiler.count('tmpkb.unidecode_fallback')
                 results = self._query(ne2)
+        profiler.stop('tmpkb.query', start)
         return results
     # --
 
@@ -428,9 +1474,7 @@ class TemporaryKB(object):
             ent_name, ent_type = ne['mention'].lower(), ne['type'][7:10]
             # print 'querying', ent_name, ent_type
             # print(ent_name, ent_type)
-            searcher = Searcher(self.tmp_index_dir)
-            results = searcher.find_by_name(ent_name)
-            searcher.close()
+            results = self.get_searcher().find_by_name(ent_name, [ent_type])
             # print(results)
             results = filter(lambda x: x['type'] == ent_type, results)
             if results is None or len(results) == 0:
@@ -448,27 +1492,61 @@ class TemporaryKB(object):
         except:
             return 'none'
 
+WIKI_MAPPING = 'mapping_refkb2wiki.tab'
+
+def read_wiki_mapping(path):
+    # (eid, url) pairs of the KB id -> wikipedia url mapping, ids without a page are skipped
+    with open(path, 'r') as f:
+        for line in f:
+            eid, name, url = line.strip('\n').split('\t')
+            if url != 'None':
+                yield eid, url
+
+def normalize_url(url):
+    title = url[url.rfind('/')+1 :]
+    lang = url[url.find('://')+3 : url.find('://')+5]
+    if lang in ["en", "ru", "uk", "es"]:
+        return '{}_wiki:{}'.format(lang, title)
+    else:
+        return url
+
+def build_wiki_table(mapping_path, table_path):
+    # eid -> normalized link, so WikiMapper neither loads nor parses the mapping at startup
+    if os.path.exists(table_path):
+        os.remove(table_path)
+    conn = sqlite3.connect(table_path)
+    conn.execute('CREATE TABLE wiki (eid TEXT PRIMARY KEY, link TEXT) WITHOUT ROWID')
+    # later lines win, like the dict WikiMapper used to load
+    conn.executemany('INSERT OR REPLACE INTO wiki VALUES (?, ?)',
+                     ((to_unicode(eid), to_unicode(normalize_url(url))) for eid, url in read_wiki_mapping(mapping_path)))
+    conn.commit()
+    conn.close()
+
 class WikiMapper(object):
-    def __init__(self):
-        self.mapping = {}
-        with open('mapping_refkb2wiki.tab', 'r') as f:
-            for line in f:
-                eid, name, url = line.strip('\n').split('\t')
-                if url != 'None':
-                    self.mapping[eid] = url
+    # looks ids up in the --build-wiki-map table when there is one, loads the whole mapping file otherwise
+    def __init__(self, table_path=None, mapping_path=WIKI_MAPPING):
+        start = time.time()
+        self.conn = None
+        self.mapping = None
+        if table_path and os.path.exists(table_path):
+            self.conn = sqlite3.connect(table_path)
+            self.conn.execute('PRAGMA mmap_size=1073741824')
+        else:
+            self.mapping = dict(read_wiki_mapping(mapping_path))
+        startup_times['wiki map'] = time.time() - start
 
     def map(self, eid):
+        if eid is None:
+            return None
+        if self.conn is not None:
+            row = self.conn.execute('SELECT link FROM wiki WHERE eid = ?', (to_unicode(eid),)).fetchone()
+            return row[0].encode('utf-8') if row is not None else None
         if eid in self.mapping:
             return self.normalize_url(self.mapping[eid])
         return None
 
     def normalize_url(self, url):
-        title = url[url.rfind('/')+1 :]
-        lang = url[url.find('://')+3 : url.find('://')+5]
-        if lang in ["en", "ru", "uk", "es"]:
-            return '{}_wiki:{}'.format(lang, title)
-        else:
-            return url
+        return normalize_url(url)
 
 
 def format_kb_id(kb_id):
@@ -476,6 +1554,589 @@ def format_kb_id(kb_id):
     return "{}:{}".format(kb_prefix, kb_id)
 
 
+def csr_mention(frame, img=False):
+    if img:
+        text = frame['label'].encode('utf-8')
+    else:
+        text = frame['provenance']['text'].encode('utf-8')
+    enttype = frame['interp']['type']
+    if type(enttype) == list:
+        enttype = enttype[0]['value']
+    return {'mention': text, 'type': enttype}
+
+
+class CsrIndex(object):
+    # the frames of a CSR document --run_csr works with, from one scan over them
+    def __init__(self, json_doc, img=False):
+        self.entities = {}
+        self.named = []
+        self.sentences = {}
+        self.clusters = []
+        for frame in json_doc['frames']:
+            ftype = frame['@type']
+            if ftype == 'entity_evidence':
+                self.entities[frame['@id']] = frame
+                if 'form' in frame['interp'] and frame['interp']['form'] == 'named':
+                    self.named.append((frame, csr_mention(frame, img)))
+            elif ftype == 'sentence':
+                self.sentences[frame['@id']] = frame['provenance']['text']
+            elif ftype == 'relation_evidence' and frame['interp']['type'] == 'aida:entity_coreference':
+                self.clusters.append([arg['arg'] for arg in frame['interp']['args']])
+
+
+def csr_linker_queries(index, args):
+    # the (ne, sentence, fringe ne) triples --run_csr sends to the reference KB, in document order
+    for frame, ne in index.named:
+        if args.en or args.es:
+            yield ne, index.sentences[frame['provenance']['reference']], None
+        elif args.ru or args.uk:
+            fringe = frame['interp']['fringe'] if 'fringe' in frame['interp'] else None
+            fne = None if fringe is None else {'mention': fringe[1:], 'type': ne['type']}
+            yield ne, '', fne
+        elif args.img:
+            yield ne, '', None
+
+def csr_frame_kept(frame):
+    # the frames --run_csr reads, everything else is copied through by write_csr
+    if frame['@type'] == 'relation_evidence':
+        return frame['interp']['type'] == 'aida:entity_coreference'
+    return frame['@type'] in ('entity_evidence', 'sentence')
+
+
+def iter_csr(f):
+    # (key, value) for the top-level keys of a CSR document and ('frames.item', frame) for each frame
+    key = builder = None
+    for prefix, event, value in ijson.parse(f):
+        if builder is None:
+            if prefix == '':
+                key = value if event == 'map_key' and value != 'frames' else None
+                continue
+            if prefix != key and prefix != 'frames.item':
+                continue
+            builder = ijson.ObjectBuilder()
+        if event == 'number' and isinstance(value, Decimal):
+            # same as json.load
+            value = float(value)
+        builder.event(event, value)
+        if (prefix == key or prefix == 'frames.item') and event not in ('start_map', 'start_array', 'map_key'):
+            yield prefix, builder.value
+            builder = None
+
+
+def load_csr(input_file, stream=False):
+    # with stream, only the csr_frame_kept() frames are held in memory
+    start = profiler.start()
+    with open(input_file, 'rb') as f:
+        if not stream:
+            json_doc = json.load(f)
+        else:
+            json_doc = {'frames': []}
+            for key, value in iter_csr(f):
+                if key != 'frames.item':
+                    json_doc[key] = value
+                elif csr_frame_kept(value):
+                    json_doc['frames'].append(value)
+    profiler.stop('json.load', start)
+    return json_doc
+
+
+class CsrFrames(list):
+    # all frames of input_file for the JSON encoder, read again one at a time,
+    # with the entity frames replaced by the linked ones
+    def __init__(self, input_file, frames):
+        list.__init__(self)
+        self.entities = dict((frame['@id'], frame) for frame in frames if frame['@type'] == 'entity_evidence')
+        self.f = open(input_file, 'rb')
+        self.frames = (value for key, value in iter_csr(self.f) if key == 'frames.item')
+        self.first = next(self.frames, None)
+
+    def __nonzero__(self):
+        return self.first is not None
+
+    def __iter__(self):
+        if self.first is None:
+            return
+        frame, self.first = self.first, None
+        while frame is not None:
+            if frame['@type'] == 'entity_evidence':
+                frame = self.entities.get(frame['@id'], frame)
+            yield frame
+            frame = next(self.frames, None)
+
+    def close(self):
+        self.f.close()
+
+
+def write_csr(json_doc, output_file, input_file=None):
+    # input_file: json_doc came from load_csr(input_file, stream=True)
+    # the output is the same as json.dumps(json_doc, indent=1, sort_keys=True, ensure_ascii=False)
+    start = profiler.start()
+    frames = None
+    if input_file is not None:
+        frames = CsrFrames(input_file, json_doc['frames'])
+        json_doc = dict(json_doc, frames=frames)
+    encoder = json.JSONEncoder(indent=1, sort_keys=True, ensure_ascii=False)
+    try:
+        # output_file may be input_file
+        with io.open(output_file + '.tmp', 'w', encoding='utf8') as f:
+            chunks = []
+            for chunk in encoder.iterencode(json_doc):
+                chunks.append(chunk)
+                if len(chunks) >= 4096:
+                    f.write(unicode(u''.join(chunks)))
+                    chunks = []
+            f.write(unicode(u''.join(chunks)))
+    finally:
+        if frames is not None:
+            frames.close()
+    os.rename(output_file + '.tmp', output_file)
+    profiler.stop('json.dump', start)
+
+
+REFKB_COMPONENT = "opera.entities.edl.refkb.xianyang"
+WIKI_COMPONENT = "opera.entities.edl.wikipedia.xianyang"
+CSR_STAGES = ('load', 'prefetch', 'link', 'tmpkb', 'coref', 'xref', 'write')
+
+
+def keep_xref(x, overwrite=False):
+    # links that survive relinking a frame
+    if x.get('component') == REFKB_COMPONENT:
+        return False
+    return not (overwrite and x.get('id', '').startswith("refkb:"))
+
+
+class PendingXref(object):
+    # the xref list of one entity frame while its document is linked, written back once at the end
+    __slots__ = ('frame', 'kept', 'added', 'stripped', 'blocked')
+
+    def __init__(self, frame, kept):
+        self.frame = frame
+        self.kept = kept
+        self.added = []
+        self.stripped = 0
+        self.blocked = False
+
+    def strip(self, overwrite=False):
+        # drops our links (all refkb links with overwrite), False when another
+        # component already linked the frame to the reference KB
+        level = 2 if overwrite else 1
+        if self.stripped < level:
+            self.kept = [x for x in self.kept if keep_xref(x, overwrite)]
+            self.blocked = any(x.get('id', '').startswith("refkb:") and x.get('component') != REFKB_COMPONENT
+                               for x in self.kept)
+            self.stripped = level
+        self.added = [x for x in self.added if keep_xref(x, overwrite)]
+        return not self.blocked
+
+    def links(self):
+        return self.kept + self.added
+
+
+class CsrDocumentLinker(object):
+    # --run_csr: links the entity frames of one CSR document at a time
+    def __init__(self, linker, tmpkb, wikimapper, args):
+        self.linker = linker
+        self.tmpkb = tmpkb
+        self.wikimapper = wikimapper
+        self.args = args
+        self.xrefs = {}
+        self.times = defaultdict(float)
+        self.documents = 0
+        # carried over between clusters and documents like the variables of the old inline loop:
+        # wikipedia links of a coreference cluster are scored with the last linking result,
+        # and a cluster without a positive vote reuses the previous vote
+        self.last_result = None
+        self.last_vote = (None, None)
+
+    def timed(self, stage, start):
+        now = time.time()
+        self.times[stage] += now - start
+        profiler.add('csr.' + stage, now - start)
+        return now
+
+    def stats(self):
+        total = sum(self.times.values())
+        return '{} documents, {}'.format(self.documents, ', '.join(
+            '{} {:.2f}s ({:.0%})'.format(stage, self.times[stage], self.times[stage] / total if total else 0.)
+            for stage in CSR_STAGES))
+
+    def link_file(self, input_file, output_file, prefetched=None, json_doc=None):
+        # prefetched: linker.prefetch() results from a --workers process, json_doc: the document it loaded
+        args = self.args
+        start = time.time()
+        if json_doc is None:
+            json_doc = load_csr(input_file, args.stream)
+        index = CsrIndex(json_doc, args.img)
+        start = self.timed('load', start)
+
+        if prefetched is None:
+            # link all named mentions of the document in one batch
+            prefetched = self.linker.prefetch(csr_linker_queries(index, args))
+        self.linker.prefetched = prefetched
+        start = self.timed('prefetch', start)
+
+        self.xrefs = {}
+        null_ents = set()
+        for frame, ne in index.named:
+            result = self.query(index, frame, ne)
+            self.last_result = result
+            if result != 'none':
+                xref = self.pending(frame)
+                if not xref.strip(args.overwrite):
+                    continue
+                xref.added.append({"@type": "db_reference",
+                    "component": REFKB_COMPONENT,
+                    "id": format_kb_id(result[0]['id']),
+                    "canonical_name": result[0]['CannonicalName'],
+                    'score': result[0]['confidence'], 'subcomponent': 0})
+                wiki_link = self.wikimapper.map(result[0]['id'])
+                if wiki_link:
+                    xref.added.append({"@type": "db_reference",
+                        "component": WIKI_COMPONENT,
+                        "id": wiki_link,
+                        'score': result[0]['confidence']})
+            else:
+                null_ents.add(frame['@id'])
+        start = self.timed('link', start)
+
+        for null_ent in null_ents:
+            frame = index.entities[null_ent]
+            result = self.tmpkb.query(csr_mention(frame, args.img))
+            self.last_result = result
+            if result != 'none':
+                xref = self.pending(frame)
+                if not xref.strip():
+                    continue
+                xref.added.append({"@type": "db_reference",
+                    "component": REFKB_COMPONENT,
+                    "id": format_kb_id(result[0]['id']),
+                    "canonical_name": result[0]['CannonicalName'],
+                    'score': result[0]['confidence'], 'subcomponent': 1})
+        start = self.timed('tmpkb', start)
+
+        for coref_cluster in index.clusters:
+            linked_ents = []
+            for eid in coref_cluster:
+                linked = self.refkb_link(index.entities[eid])
+                if not linked is None:
+                    linked_ents.append(linked)
+            if len(linked_ents) == 0:
+                self.register_cluster(index, coref_cluster)
+            else:
+                self.vote_cluster(index, coref_cluster, linked_ents)
+        start = self.timed('coref', start)
+
+        for xref in self.xrefs.itervalues():
+            xref.frame['interp']['xref'] = xref.links()
+        self.xrefs = {}
+        start = self.timed('xref', start)
+
+        write_csr(json_doc, output_file, input_file if args.stream else None)
+        self.linker.flush()
+        self.linker.prefetched = {}
+        self.tmpkb.commit()
+        self.timed('write', start)
+        self.documents += 1
+
+    def query(self, index, frame, ne):
+        args = self.args
+        result = 'none'
+        if args.en or args.es:
+            result = self.linker.query(ne, index.sentences[frame['provenance']['reference']])
+        elif args.ru or args.uk:
+            fringe = frame['interp']['fringe'] if 'fringe' in frame['interp'] else None
+            result = self.linker.query(ne, '')
+            if result != 'none' and not fringe is None:
+                fne = {'mention': fringe[1:], 'type': ne['type']}
+                fresult = self.linker.query(fne, '')
+                if fresult != 'none':
+                    result_dict = dict([(ru_res['id'], ru_res) for ru_res in result])
+                    for en_res in fresult:
+                        if en_res['id'] in result_dict:
+                            newscore = en_res['confidence'] + result_dict[en_res['id']]['confidence']
+                            newscore = min(1.0, newscore)
+                            result_dict[en_res['id']]['confidence'] = newscore
+                        else:
+                            result_dict[en_res['id']] = en_res
+                    result = list(result_dict.values())
+                    result.sort(key=lambda x: -x['confidence'])
+        elif args.img:
+            result = self.linker.query(ne, '')
+        return result
+
+    def pending(self, frame):
+        xref = self.xrefs.get(id(frame))
+        if xref is None:
+            xref = self.xrefs[id(frame)] = PendingXref(frame, frame['interp'].get('xref', []))
+        return xref
+
+    def refkb_link(self, frame):
+        xref = self.xrefs.get(id(frame))
+        links = xref.links() if xref is not None else frame['interp'].get('xref', [])
+        for link in links:
+            if link.get('component') == REFKB_COMPONENT:
+                return link
+        return None
+
+    def register_cluster(self, index, coref_cluster):
+        # register new KB entry
+        mention_counter = defaultdict(int)
+        for eid in coref_cluster:
+            frame = index.entities[eid]
+            if 'form' not in frame['interp'] or frame['interp']['form'] != 'named':
+                continue
+            mention = frame['provenance']['text']
+            mention_counter[mention] += 1
+        best_mention = None
+        max_count = 0
+        for mention, count in mention_counter.items():
+            if count > max_count:
+                max_count = count
+                best_mention = mention
+            elif count == max_count:
+                if len(mention) > len(best_mention):
+                    best_mention = mention
+        if best_mention is None:
+            return
+        for eid in coref_cluster:
+            if index.entities[eid]['provenance']['text'] == best_mention:
+                enttype = index.entities[eid]['interp']['type']
+                break
+        if type(enttype) == list:
+            enttype = enttype[0]['value']
+        enttype = enttype[7:10]
+        if enttype not in ['GPE', 'LOC', 'FAC', 'PER', 'ORG', 'VEH', 'WEA']:
+            return
+        tid = self.tmpkb.register(best_mention.lower(), enttype)
+        for eid in coref_cluster:
+            xref = self.pending(index.entities[eid])
+            if not xref.strip():
+                continue
+            xref.added.append({"@type": "db_reference",
+                "component": REFKB_COMPONENT,
+                "id": format_kb_id(tid),
+                "canonical_name": best_mention,
+                'score': 1.0, 'subcomponent': 2})
+
+    def vote_cluster(self, index, coref_cluster, linked_ents):
+        # coreferent mentions should be linked to the same entity
+        votes = defaultdict(float)
+        for linked in linked_ents:
+            votes[linked['id']] += linked['score']
+        votedid, final_linking = self.last_vote
+        max_vote = 0
+        for eid, vote_score in votes.items():
+            if vote_score > max_vote:
+                max_vote = vote_score
+                votedid = eid
+        votedwiki = self.wikimapper.map(votedid)
+        for linked in linked_ents:
+            if linked['id'] == votedid:
+                final_linking = linked
+                break
+        self.last_vote = (votedid, final_linking)
+        for eid in coref_cluster:
+            frame = index.entities[eid]
+            if id(frame) in self.xrefs or 'xref' in frame['interp']:
+                xref = self.pending(frame)
+                if not xref.strip(self.args.overwrite):
+                    continue
+            else:
+                xref = self.xrefs[id(frame)] = PendingXref(frame, [])
+            xref.added.append(final_linking)
+            if votedwiki:
+                xref.added.append({"@type": "db_reference",
+                    "component": WIKI_COMPONENT,
+                    "id": votedwiki,
+                    'score': self.last_result[0]['confidence']})
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def file_stat(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+
+def csr_settings(args):
+    # the options that change --run_csr output, recorded in the manifest
+    return {'lang': [lang for lang in ('en', 'es', 'ru', 'uk', 'img') if getattr(args, lang)],
+            'overwrite': args.overwrite,
+            'country_codes': sorted(args.country_codes),
+            'exact_index': args.exact_index}
+
+
+class Manifest(object):
+    # append-only JSON lines, one record per input file linked (or failed), the last record of a file counts
+    def __init__(self, path, index, settings):
+        self.index = index
+        self.settings = settings
+        self.records = {}
+        complete = True
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    complete = line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # cut short by a crash
+                        continue
+                    self.records[record['file']] = record
+        self.f = open(path, 'a')
+        if not complete:
+            self.f.write('\n')
+
+    def done(self, fname, sha1=None):
+        # linked with the same index and settings (and from the same input with sha1)
+        record = self.records.get(fname)
+        if record is None or record['status'] != 'done':
+            return False
+        if record['index'] != self.index or record['settings'] != self.settings:
+            return False
+        return sha1 is None or record.get('sha1') == sha1
+
+    def same_stat(self, fname, stat):
+        # input size and mtime as recorded, the file is taken as unchanged without hashing it
+        record = self.records.get(fname)
+        return record is not None and (record.get('size'), record.get('mtime')) == stat
+
+    def add(self, fname, sha1, status, seconds, stat=None):
+        # sha1 is only computed for --changed-only, size and mtime always
+        record = {'file': fname, 'sha1': sha1, 'index': self.index, 'settings': self.settings,
+                  'status': status, 'seconds': round(seconds, 3), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        if stat is not None:
+            record['size'], record['mtime'] = stat
+        self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.f.flush()
+        self.records[fname] = record
+
+    def close(self):
+        self.f.close()
+
+
+_worker = {}
+
+def init_csr_worker(linker_args, args):
+    # --profile only reports the parent process
+    profiler.enabled = False
+    _worker['linker'] = EntityLinker(*linker_args)
+    _worker['args'] = args
+
+# documents per --workers process that are loaded and linked ahead of the serial stages in the parent
+PREFETCH_AHEAD = 2
+
+def prefetch_csr_file(input_file):
+    # runs in a --workers process: load one document and link every reference KB query of it,
+    # returns (json_doc, prefetched) so the parent does not parse the file again.
+    # TemporaryKB stages stay in the parent so tmpkb ids are handed out in serial order.
+    linker = _worker['linker']
+    try:
+        json_doc = load_csr(input_file, _worker['args'].stream)
+        args = _worker['args']
+        prefetched = linker.prefetch(csr_linker_queries(CsrIndex(json_doc, args.img), args))
+        linker.flush()
+    except Exception:
+        # the parent redoes the document itself and reports the error
+        return None, None
+    return json_doc, prefetched
+
+
+class LinkingService(object):
+    # the JSON API behind --serve, mentions and types are the same as for EntityLinker.query
+    def __init__(self, linker, tmpkb, wikimapper=None):
+        self.linker = linker
+        self.tmpkb = tmpkb
+        self.wikimapper = wikimapper
+
+    def handle(self, path, request):
+        if path == '/link':
+            results = self.linker.query(self.mention(request), request.get('sentence', ''))
+            self.linker.flush()
+            return results
+        elif path == '/link_batch':
+            mentions = [(self.mention(m), m.get('sentence', '')) for m in request['mentions']]
+            results = self.linker.query_batch(mentions)
+            self.linker.flush()
+            return results
+        elif path == '/tmpkb/query':
+            return self.tmpkb.query(self.mention(request))
+        elif path == '/tmpkb/register':
+            tid = self.tmpkb.register(request['name'].encode('utf-8'), request['type'])
+            self.tmpkb.commit()
+            return tid
+        elif path == '/wiki':
+            if self.wikimapper is None:
+                return None
+            return self.wikimapper.map(request['id'])
+        elif path == '/stats':
+            return {'cache': self.linker.cache_stats()}
+        return None
+
+    paths = ('/link', '/link_batch', '/tmpkb/query', '/tmpkb/register', '/wiki', '/stats')
+
+    def mention(self, request):
+        return {'mention': request['mention'].encode('utf-8'), 'type': request['type']}
+
+
+class LinkingRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # HTTP/1.0: the connection is closed after every response, the server is single-threaded
+    # and a client keeping its connection open (linking_client.py --query) would block all others
+    protocol_version = 'HTTP/1.0'
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            request = json.loads(self.rfile.read(length)) if length else {}
+            if self.path not in LinkingService.paths:
+                status, response = 404, {'error': 'unknown path {}'.format(self.path)}
+            else:
+                status, response = 200, self.server.service.handle(self.path, request)
+        except (KeyError, ValueError) as e:
+            status, response = 400, {'error': repr(e)}
+        except Exception as e:
+            traceback.print_exc()
+            status, response = 500, {'error': repr(e)}
+        body = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def address_string(self):
+        # unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        sys.stderr.write("{} - {}\n".format(self.address_string(), format % args))
+
+
+class UnixHTTPServer(SocketServer.UnixStreamServer):
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+
+
+def make_server(address, service):
+    # address is host:port or unix:/path/to/socket
+    if address.startswith('unix:'):
+        server = UnixHTTPServer(address[len('unix:'):], LinkingRequestHandler)
+    else:
+        host, port = address.rsplit(':', 1)
+        server = BaseHTTPServer.HTTPServer((host, int(port)), LinkingRequestHandler)
+    server.service = service
+    return server
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
@@ -496,10 +2157,74 @@ if __name__ == '__main__':
     parser.add_argument('--in_dir', type=str)
     parser.add_argument('--out_dir', type=str)
     parser.add_argument('--map_file', type=str)
+    parser.add_argument('--serve', type=str, metavar='ADDRESS',
+                        help="run the linking service on host:port or unix:/path/to/socket, see linking_client.py")
     parser.add_argument('--overwrite', action='store_true', help="Overwrite existing refkb from other components")
+    parser.add_argument('--cache-size', type=int, default=100000,
+                        help="max number of mentions kept in the in-memory linking cache (0 disables it)")
+    parser.add_argument('--disk-cache', nargs='?', const='', default=None, type=str,
+                        help="keep linking results in a sqlite cache shared between runs "
+                             "(default file: INDEX_DIR/linking_cache.sqlite)")
+    parser.add_argument('--stream', action='store_true',
+                        help="--run_csr: read and write CSR documents incrementally (needs ijson), only entity, "
+                             "sentence and coreference frames are kept in memory")
+    parser.add_argument('--resume', action='store_true',
+                        help="--run_csr: skip files OUT_DIR/linking_manifest.jsonl lists as linked "
+                             "with the same index and settings")
+    parser.add_argument('--changed-only', action='store_true',
+                        help="--run_csr: like --resume, but also relink files whose content changed since")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="--run_csr: number of processes linking documents against the reference KB")
+    parser.add_argument('--shard-by-type', action='store_true',
+                        help="--index: write one index per type group (GPE/LOC/FAC, PER, ORG, other) "
+                             "under INDEX_DIR/lucene_index/; linking picks the shards up automatically")
+    parser.add_argument('--index-ram-mb', type=int, default=64,
+                        help="--index: IndexWriter RAM buffer size in MB, split between the writers with "
+                             "--shard-by-type and capped to half of the JVM heap; larger buffers need a larger "
+                             "heap, e.g. --jvm-args -Xmx4g")
+    parser.add_argument('--index-threads', type=int, default=1,
+                        help="--index: number of indexing threads (more than 1 does not keep KB file order "
+                             "in the index, so ties between equally scored candidates may break differently)")
+    parser.add_argument('--profile', action='store_true',
+                        help="report counts and timings of searches, scoring, temporary KB and JSON I/O on exit "
+                             "(this process only, not --workers)")
+    parser.add_argument('--profile-out', type=str, default=None,
+                        help="with --profile, also write cProfile stats to this file (see python -m pstats)")
+    parser.add_argument('--build-wiki-map', nargs='?', const=WIKI_MAPPING, default=None, type=str,
+                        help="turn the KB id -> wikipedia mapping (default: {}) into INDEX_DIR/wiki_map.sqlite, "
+                             "which --run_csr and --serve then use instead of the mapping file".format(WIKI_MAPPING))
+    parser.add_argument('--query-threads', type=int, default=1,
+                        help="search the mentions of a batch on this many threads sharing one index reader")
+    parser.add_argument('--jvm-args', type=str, default='',
+                        help="extra JVM options, e.g. '-Xms2g -Xmx8g -XX:+UseG1GC'; the JVM only starts "
+                             "once something has to be searched or indexed")
+    parser.add_argument('--directory', choices=sorted(DIRECTORY_TYPES), default=None,
+                        help="Lucene directory implementation (default: mmap on 64-bit linux, simple elsewhere)")
+    parser.add_argument('--force-merge', action='store_true',
+                        help="--index: merge the new index into a single segment")
+    parser.add_argument('--warm-up', action='store_true',
+                        help="read the reference index once and run a few searches before linking")
+    parser.add_argument('--backend', choices=BACKENDS, default='lucene',
+                        help="candidate search: lucene_index/ or INDEX_DIR/sqlite_index.sqlite (FTS5, no JVM), "
+                             "--index builds the one chosen")
+    parser.add_argument('--exact-index', action='store_true',
+                        help="build (with --index) or use INDEX_DIR/exact_names.sqlite to answer exact name "
+                             "matches without Lucene; Lucene still handles misses and fuzzy search")
     args = parser.parse_args()
 
     print "Using country codes: " + " ".join(args.country_codes)
+    JVM_ARGS += args.jvm_args.split()
+    atexit.register(lambda: sys.stderr.write("startup: {}\n".format(startup_report())))
+    if args.profile:
+        profiler.enabled = True
+        atexit.register(lambda: sys.stderr.write("profile:\n{}\n".format(profiler.report())))
+        if args.profile_out:
+            cprofile = cProfile.Profile()
+            atexit.register(cprofile.dump_stats, args.profile_out)
+            atexit.register(cprofile.disable)
+            cprofile.enable()
+    if args.stream and ijson is None:
+        sys.exit('ERROR: --stream needs ijson (pip install ijson)')
     if args.sp:
         args.es = args.sp
 
@@ -507,30 +2232,56 @@ if __name__ == '__main__':
         os.makedirs(args.out_dir)
 
     lucene_index_dir = os.path.join(args.index_dir, 'lucene_index/')
+    sqlite_index_path = os.path.join(args.index_dir, 'sqlite_index.sqlite')
+    index_path = sqlite_index_path if args.backend == 'sqlite' else lucene_index_dir
     tmp_index_dir = os.path.join(args.index_dir, 'tmp_index/')
+    cache_path = None
+    if args.disk_cache is not None:
+        cache_path = args.disk_cache or os.path.join(args.index_dir, 'linking_cache.sqlite')
+    exact_index_path = None
+    if args.exact_index:
+        exact_index_path = os.path.join(args.index_dir, 'exact_names.sqlite')
+    linker_args = (index_path, args.country_codes, args.cache_size, cache_path, exact_index_path,
+                   args.warm_up, args.query_threads, args.backend)
+    DIRECTORY_TYPE = args.directory
+    wiki_table_path = os.path.join(args.index_dir, 'wiki_map.sqlite')
+
+    if args.build_wiki_map:
+        build_wiki_table(args.build_wiki_map, wiki_table_path)
 
     if args.index:
         # if os.path.exists(lucene_index_dir):
             # sys.exit('ERROR: ' + lucene_index_dir + ' already exists!')
-        data_cleaning(os.path.join(args.index, 'data/entities.tab'),
-                      os.path.join(args.index_dir, 'cleaned.tab'),
-                      args.country_codes)
-        lucene.initVM(vmargs=['-Djava.awt.headless=true'])
-        indexer = Indexer(lucene_index_dir)
-        for eid, name, cname, type, info in load_id2name(
-                os.path.join(args.index_dir, 'cleaned.tab'),
-                os.path.join(args.index, 'data/alternate_names.tab')):
-            indexer.index(eid, name, cname, type, info)
-            # --
-            # normed name
-            normed_name = unidecode(name.decode("utf-8"))
-            if normed_name != name:
-                indexer.index(eid, normed_name, cname, type, info)
-            # --
+        if args.backend == 'sqlite' and args.shard_by_type:
+            sys.exit('ERROR: --shard-by-type only applies to --backend lucene')
+        if args.backend == 'lucene' and os.path.isdir(lucene_index_dir):
+            # appending to an existing index has to keep its layout
+            if args.shard_by_type and any(f.startswith('segments') for f in os.listdir(lucene_index_dir)):
+                sys.exit('ERROR: ' + lucene_index_dir + ' was built without --shard-by-type')
+            if not args.shard_by_type and has_type_shards(lucene_index_dir):
+                sys.exit('ERROR: ' + lucene_index_dir + ' was built with --shard-by-type')
+        index_threads = args.index_threads
+        if args.backend == 'sqlite':
+            indexer = SqliteIndexer(sqlite_index_path)
+            index_threads = 1
+        elif args.shard_by_type:
+            indexer = ShardedIndexer(lucene_index_dir, args.index_ram_mb)
+        else:
+            indexer = Indexer(lucene_index_dir, args.index_ram_mb)
+        exact_index = ExactNameIndex(exact_index_path) if exact_index_path else None
+        index_kb(indexer,
+                 kb_documents(os.path.join(args.index, 'data/entities.tab'),
+                              os.path.join(args.index, 'data/alternate_names.tab'),
+                              args.country_codes),
+                 index_threads, exact_index)
+        if args.force_merge:
+            # one segment per index: fewer files to search and to keep in the page cache
+            indexer.force_merge(1)
         indexer.close()
+        if exact_index is not None:
+            exact_index.close()
     elif args.run:
-        lucene.initVM(vmargs=['-Djava.awt.headless=true'])
-        linker = EntityLinker(lucene_index_dir, args.country_codes)
+        linker = EntityLinker(*linker_args)
         tmpkb = TemporaryKB(tmp_index_dir)
         input_dir = args.dir
         for fname in os.listdir(input_dir):
@@ -539,6 +2290,13 @@ if __name__ == '__main__':
                 print input_file
                 with open(input_file, 'r') as f:
                     json_doc = json.load(f)
+                try:
+                    linker.prefetched = linker.prefetch((ner, sentence['inputSentence'], None)
+                                                        for sentence in json_doc
+                                                        for ner in sentence['namedMentions'])
+                except Exception:
+                    # link mention by mention below
+                    linker.prefetched = {}
                 null_ents = []
                 for sentence in json_doc:
                     sent_text = sentence['inputSentence']
@@ -567,240 +2325,79 @@ if __name__ == '__main__':
                 
                 with open(input_file, 'w') as f:
                     json.dump(json_doc, f, indent=1, sort_keys=True)
+                linker.flush()
+                linker.prefetched = {}
+                tmpkb.commit()
             except Exception:
                 sys.stderr.write("ERROR: Exception occurred while processing {0}\n".format(fname))
                 traceback.print_exc()
+                tmpkb.rollback()
+                linker.prefetched = {}
+        tmpkb.close()
+        linker.flush()
+        sys.stderr.write("linking cache: {}\n".format(linker.cache_stats()))
     elif args.run_csr:
-        lucene.initVM(vmargs=['-Djava.awt.headless=true'])
-        linker = EntityLinker(lucene_index_dir, args.country_codes)
+        input_dir = args.in_dir
+        fnames = [fname for fname in os.listdir(input_dir) if fname.endswith(".csr.json")]
+        manifest = Manifest(os.path.join(args.out_dir, 'linking_manifest.jsonl'),
+                            index_version(index_path), csr_settings(args))
+        sha1s = {}
+        if args.resume or args.changed_only:
+            todo = []
+            for fname in fnames:
+                sha1 = None
+                if args.changed_only and not manifest.same_stat(fname, file_stat(os.path.join(input_dir, fname))):
+                    # touched or rewritten, hash it to tell
+                    sha1 = sha1s[fname] = file_sha1(os.path.join(input_dir, fname))
+                if not manifest.done(fname, sha1) or not os.path.exists(os.path.join(args.out_dir, fname)):
+                    todo.append(fname)
+            print 'skipping {} of {} files already linked'.format(len(fnames) - len(todo), len(fnames))
+            fnames = todo
+        pool = None
+        prefetched = deque()
+        ahead = args.workers * PREFETCH_AHEAD
+        if args.workers > 1:
+            # fork the pool before this process starts its own JVM
+            pool = multiprocessing.Pool(args.workers, init_csr_worker, (linker_args, args))
+            # only a few documents in flight, the parent holds their results until it gets to them
+            for fname in fnames[:ahead]:
+                prefetched.append(pool.apply_async(prefetch_csr_file, (os.path.join(input_dir, fname),)))
+
+        linker = EntityLinker(*linker_args)
         tmpkb = TemporaryKB(tmp_index_dir)
-        wikimapper = WikiMapper()
+        wikimapper = WikiMapper(wiki_table_path)
+        doc_linker = CsrDocumentLinker(linker, tmpkb, wikimapper, args)
 
-        input_dir = args.in_dir
-        for fname in os.listdir(input_dir):
+        for k, fname in enumerate(fnames):
+            json_doc, batch = None, None
+            if pool is not None:
+                json_doc, batch = prefetched.popleft().get()
+                if k + ahead < len(fnames):
+                    prefetched.append(pool.apply_async(prefetch_csr_file,
+                                                       (os.path.join(input_dir, fnames[k + ahead]),)))
+            start = time.time()
+            sha1 = sha1s.pop(fname, None)
+            stat = None
             try:
-                if not fname.endswith(".csr.json"):
-                    continue
                 input_file = os.path.join(input_dir, fname)
                 print input_file
-                with open(input_file, 'r') as f:
-                    json_doc = json.load(f)
-
-                ent_clusters = []
-                for frame in json_doc['frames']:
-                    if frame['@type'] == 'relation_evidence' and frame['interp']['type'] == 'aida:entity_coreference':
-                        cluster = []
-                        for arg in frame['interp']['args']:
-                            cluster.append(arg['arg'])
-                        ent_clusters.append(cluster)
-                # print ent_clusters
-
-                if args.en or args.es:
-                    sentences = {}
-                    for frame in json_doc['frames']:
-                        if frame['@type'] == 'sentence':
-                            sentences[frame['@id']] = frame['provenance']['text']
-                    # print sentences
-
-                id2entity = {}
-                null_ents = set()
-                linked_ents = {}
-
-                for frame in json_doc['frames']:
-                    if frame['@type'] != 'entity_evidence':
-                        continue
-                    id2entity[frame['@id']] = frame
-                    if 'form' not in frame['interp'] or frame['interp']['form'] != 'named':
-                        continue
-                    if args.img:
-                        text = frame['label'].encode('utf-8')
-                    else:
-                        text = frame['provenance']['text'].encode('utf-8')
-                    enttype = frame['interp']['type']
-                    if type(enttype) == list:
-                        enttype = enttype[0]['value']
-                    if args.en or args.es:
-                        sent = sentences[frame['provenance']['reference']]
-                        # print text, enttype
-                        ne = {'mention': text, 'type': enttype}
-                        result = linker.query(ne, sent)
-                    elif args.ru or args.uk:
-                        fringe = frame['interp']['fringe'] if 'fringe' in frame['interp'] else None
-                        # print text, enttype, fringe
-                        ne = {'mention': text, 'type': enttype}
-                        result = linker.query(ne, '')
-                        if result != 'none' and not fringe is None:
-                            fne = {'mention': fringe[1:], 'type': enttype}
-                            fresult = linker.query(fne, '')
-                            if fresult != 'none':
-                                result_dict = dict([(ru_res['id'], ru_res) for ru_res in result])
-                                for en_res in fresult:
-                                    if en_res['id'] in result_dict:
-                                        newscore = en_res['confidence'] + result_dict[en_res['id']]['confidence']
-                                        newscore = min(1.0, newscore)
-                                        result_dict[en_res['id']]['confidence'] = newscore
-                                    else:
-                                        result_dict[en_res['id']] = en_res
-                                result = list(result_dict.values())
-                                result.sort(key=lambda x: -x['confidence'])
-                    elif args.img:
-                        # print text, enttype
-                        ne = {'mention': text, 'type': enttype}
-                        result = linker.query(ne, '')
-
-                    if result != 'none':
-                        # print result
-                        if 'xref' not in frame['interp']:
-                            frame['interp']['xref'] = []
-                        if args.overwrite:  # excluding existing ones!
-                            frame['interp']['xref'] = filter(lambda x: x.get('component') != "opera.entities.edl.refkb.xianyang" and not x.get('id', '').startswith("refkb:"), frame['interp']['xref'])
-                        else:
-                            frame['interp']['xref'] = filter(lambda x: x.get('component') != "opera.entities.edl.refkb.xianyang", frame['interp']['xref'])
-                        if any(x.get('id', '').startswith("refkb:") and x.get('component') != "opera.entities.edl.refkb.xianyang" for x in frame['interp']['xref']):
-                            continue
-                        frame['interp']['xref'].append({"@type": "db_reference", 
-                            "component": "opera.entities.edl.refkb.xianyang",
-                            "id": format_kb_id(result[0]['id']),
-                            "canonical_name": result[0]['CannonicalName'], 
-                            'score': result[0]['confidence'], 'subcomponent': 0})
-                        wiki_link = wikimapper.map(result[0]['id'])
-                        if wiki_link:
-                            frame['interp']['xref'].append({"@type": "db_reference", 
-                            "component": "opera.entities.edl.wikipedia.xianyang",
-                            "id": wiki_link, 
-                            'score': result[0]['confidence']})
-                        
-                    else:
-                        null_ents.add(frame['@id'])
-
-                for null_ent in null_ents:
-                    frame = id2entity[null_ent]
-                    if args.img:
-                        text = frame['label'].encode('utf-8')
-                    else:
-                        text = frame['provenance']['text'].encode('utf-8')
-                    enttype = frame['interp']['type']
-                    if type(enttype) == list:
-                        enttype = enttype[0]['value']
-                    ne = {'mention': text, 'type': enttype}
-                    result = tmpkb.query(ne)
-                    if result != 'none':
-                        # print '****', result
-                        if 'xref' not in frame['interp']:
-                            frame['interp']['xref'] = []
-                        frame['interp']['xref'] = filter(lambda x: x.get('component') != "opera.entities.edl.refkb.xianyang", frame['interp']['xref'])
-                        if any(x.get('id', '').startswith("refkb:") and x.get('component') != "opera.entities.edl.refkb.xianyang" for x in frame['interp']['xref']):
-                            continue
-                        frame['interp']['xref'].append({"@type": "db_reference", 
-                            "component": "opera.entities.edl.refkb.xianyang",
-                            "id": format_kb_id(result[0]['id']),
-                            "canonical_name": result[0]['CannonicalName'], 
-                            'score': result[0]['confidence'], 'subcomponent': 1})
-                        # wiki_link = wikimapper.map(result[0]['id'])
-                        # if wiki_link:
-                        #     frame['interp']['xref'].append({"@type": "db_reference", 
-                        #     "component": "opera.entities.edl.wikipedia.xianyang",
-                        #     "id": wiki_link, 
-                        #     'score': result[0]['confidence']})
-
-                for coref_cluster in ent_clusters:
-                    linked_ents = []
-                    for eid in coref_cluster:
-                        frame = id2entity[eid]
-                        if 'xref' in frame['interp']:
-                            linked = None
-                            for link_res in frame['interp']['xref']:
-                                if link_res.get('component') == "opera.entities.edl.refkb.xianyang":
-                                    linked = link_res
-                                    break
-                            if not linked is None:
-                                linked_ents.append(linked)
-                    # print(linked_ents)
-                    
-                    if len(linked_ents) == 0:
-                        # register new KB entry
-                        mention_counter = defaultdict(int)
-                        for eid in coref_cluster:
-                            frame = id2entity[eid]
-                            if 'form' not in frame['interp'] or frame['interp']['form'] != 'named':
-                                continue
-                            mention = frame['provenance']['text']
-                            mention_counter[mention] += 1
-                        # print mention_counter
-                        best_mention = None
-                        max_count = 0
-                        for mention, count in mention_counter.items():
-                            if count > max_count:
-                                max_count = count
-                                best_mention = mention
-                            elif count == max_count:
-                                if len(mention) > len(best_mention):
-                                    best_mention = mention
-                        if not best_mention is None:
-                            for eid in coref_cluster:
-                                if id2entity[eid]['provenance']['text'] == best_mention:
-                                    enttype = id2entity[eid]['interp']['type']
-                                    break
-                            if type(enttype) == list:
-                                enttype = enttype[0]['value']
-                            enttype = enttype[7:10]
-                            if enttype in ['GPE', 'LOC', 'FAC', 'PER', 'ORG', 'VEH', 'WEA']:
-                                # for eid in coref_cluster:
-                                    # print '!', id2entity[eid]
-                                tid = tmpkb.register(best_mention.lower(), enttype)
-                                print tmpkb.query({'mention': best_mention, 'type': 'ldcOnt:'+enttype})
-                                for eid in coref_cluster:
-                                    frame = id2entity[eid]
-                                    if 'xref' not in frame['interp']:
-                                        frame['interp']['xref'] = []
-                                    frame['interp']['xref'] = filter(lambda x: x.get('component') != "opera.entities.edl.refkb.xianyang", frame['interp']['xref'])
-                                    if any(x.get('id', '').startswith("refkb:") and x.get('component') != "opera.entities.edl.refkb.xianyang" for x in frame['interp']['xref']):
-                                        continue
-                                    frame['interp']['xref'].append({"@type": "db_reference", 
-                                    "component": "opera.entities.edl.refkb.xianyang",
-                                    "id": format_kb_id(tid),
-                                    "canonical_name": best_mention, 
-                                    'score': 1.0, 'subcomponent': 2})
-                    else:
-                        # coreferent mentions should be linked to the same entity
-                        votes = defaultdict(float)
-                        for linked in linked_ents:
-                            votes[linked['id']] += linked['score']
-                        max_vote = 0
-                        for eid, vote_score in votes.items():
-                            if vote_score > max_vote:
-                                max_vote = vote_score
-                                votedid = eid
-                        votedwiki = wikimapper.map(votedid)
-                        for linked in linked_ents:
-                            if linked['id'] == votedid:
-                                final_linking = linked
-                                break
-                        for eid in coref_cluster:
-                            frame = id2entity[eid]
-                            if 'xref' in frame['interp']:
-                                if args.overwrite:  # excluding existing ones!
-                                    frame['interp']['xref'] = filter(lambda x: x.get('component') != "opera.entities.edl.refkb.xianyang" and not x.get('id', '').startswith("refkb:"), frame['interp']['xref'])
-                                else:
-                                    frame['interp']['xref'] = filter(lambda x: x.get('component') != "opera.entities.edl.refkb.xianyang", frame['interp']['xref'])
-                                if any(x.get('id', '').startswith("refkb:") and x.get('component') != "opera.entities.edl.refkb.xianyang" for x in frame['interp']['xref']):
-                                    continue
-                                frame['interp']['xref'].append(final_linking)
-                            else:
-                                frame['interp']['xref'] = [final_linking]
-                            if votedwiki:
-                                frame['interp']['xref'].append({"@type": "db_reference", 
-                                    "component": "opera.entities.edl.wikipedia.xianyang",
-                                    "id": votedwiki, 
-                                    'score': result[0]['confidence']})
-                
-                # with open(os.path.join(args.out_dir, fname), 'w') as f:
-                #     json.dump(json_doc, f, indent=1, sort_keys=True)
-                with io.open(os.path.join(args.out_dir, fname), 'w', encoding='utf8') as f:
-                    f.write(unicode(json.dumps(json_doc, indent=1, sort_keys=True, ensure_ascii=False)))
+                stat = file_stat(input_file)
+                doc_linker.link_file(input_file, os.path.join(args.out_dir, fname), batch, json_doc)
+                manifest.add(fname, sha1, 'done', time.time() - start, stat)
             except Exception:
                 sys.stderr.write("ERROR: Exception occurred while processing {0}\n".format(fname))
                 traceback.print_exc()
+                tmpkb.rollback()
+                linker.prefetched = {}
+                manifest.add(fname, sha1, 'failed', time.time() - start, stat)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        manifest.close()
+        tmpkb.close()
+        linker.flush()
+        sys.stderr.write("linking cache: {}\n".format(linker.cache_stats()))
+        sys.stderr.write("csr stages: {}\n".format(doc_linker.stats()))
     # elif args.run_csr_ru:
     #     lucene.initVM(vmargs=['-Djava.awt.headless=true'])
     #     linker = EntityLinker(lucene_index_dir, args.country_codes)
@@ -853,16 +2450,31 @@ if __name__ == '__main__':
             
             # with open(input_file, 'w') as f:
             #     json.dump(json_doc, f, indent=1, sort_keys=True)
+    elif args.serve:
+        linker = EntityLinker(*linker_args)
+        tmpkb = TemporaryKB(tmp_index_dir)
+        wikimapper = None
+        if os.path.exists(wiki_table_path) or os.path.exists(WIKI_MAPPING):
+            wikimapper = WikiMapper(wiki_table_path)
+        server = make_server(args.serve, LinkingService(linker, tmpkb, wikimapper))
+        print 'serving on', args.serve
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            tmpkb.close()
+            linker.flush()
+            server.server_close()
     elif args.query:
-        lucene.initVM(vmargs=['-Djava.awt.headless=true'])
-        linker = EntityLinker(lucene_index_dir, args.country_codes)
+        linker = EntityLinker(*linker_args)
         while True:
             name = raw_input('name:')
             ntype = raw_input('type:')
             ne = {'mention': name, 'type': 'ldcOnt:'+ntype}
             print linker.query(ne, '')
+            linker.flush()
     elif args.query_tmp:
-        lucene.initVM(vmargs=['-Djava.awt.headless=true'])
         linker = TemporaryKB(tmp_index_dir)
         while True:
             name = raw_input('name:')
@@ -870,8 +2482,7 @@ if __name__ == '__main__':
             ne = {'mention': name, 'type': 'ldcOnt:'+ntype}
             print linker.query(ne)
     elif args.map_file:
-        lucene.initVM(vmargs=['-Djava.awt.headless=true'])
-        linker = EntityLinker(lucene_index_dir, args.country_codes)
+        linker = EntityLinker(*linker_args)
 
         if 'named_gpe' in args.map_file:
             enttype = 'ldcOnt:GPE'
@@ -908,3 +2519,5 @@ if __name__ == '__main__':
                                 org = info[2]
                                 print(out + u'\t{}\t{}\t{}\t{}\t{}'.format(refkbid, refkbname, country, title, org)).encode('utf-8')
                     # print out.encode('utf-8')
+        linker.flush()
+        sys.stderr.write("linking cache: {}\n".format(linker.cache_stats()))
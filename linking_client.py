@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# thin client for `python linking.py --serve ADDRESS`, needs no lucene
+import httplib
+import socket
+import json
+import sys
+import argparse
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class LinkingClient(object):
+    def __init__(self, address):
+        # address is host:port or unix:/path/to/socket, as given to --serve
+        if address.startswith('unix:'):
+            self.connection = UnixHTTPConnection(address[len('unix:'):])
+        else:
+            host, port = address.rsplit(':', 1)
+            self.connection = httplib.HTTPConnection(host, int(port))
+
+    def call(self, path, request=None):
+        body = json.dumps(request) if request is not None else ''
+        self.connection.request('POST', path, body, {'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError('{} {}: {}'.format(path, response.status, result.get('error')))
+        return result
+
+    def link(self, mention, type, sentence=''):
+        return self.call('/link', {'mention': mention, 'type': type, 'sentence': sentence})
+
+    def link_batch(self, mentions):
+        # mentions: list of {'mention': .., 'type': .., 'sentence': ..}
+        return self.call('/link_batch', {'mentions': mentions})
+
+    def query_tmp(self, mention, type):
+        return self.call('/tmpkb/query', {'mention': mention, 'type': type})
+
+    def register(self, name, type):
+        return self.call('/tmpkb/register', {'name': name, 'type': type})
+
+    def wiki(self, eid):
+        return self.call('/wiki', {'id': eid})
+
+    def stats(self):
+        return self.call('/stats')
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', type=str, required=True)
+    parser.add_argument('--query', action='store_true')
+    parser.add_argument('--batch', action='store_true', help="json mentions on stdin, one per line")
+    args = parser.parse_args()
+
+    client = LinkingClient(args.server)
+    if args.query:
+        while True:
+            try:
+                name = raw_input('name:').decode('utf-8')
+                ntype = raw_input('type:')
+            except EOFError:
+                break
+            print client.link(name, 'ldcOnt:'+ntype)
+    elif args.batch:
+        mentions = [json.loads(line) for line in sys.stdin if line.strip()]
+        for result in client.link_batch(mentions):
+            print json.dumps(result, ensure_ascii=False).encode('utf-8')
+    else:
+        print client.stats()
+    client.close()
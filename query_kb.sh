@@ -10,4 +10,9 @@ source activate xy_linking
 set -x
 
 shift 1
-python linking.py --query --index-dir $index_dir --country-codes "${@}"
+if [ -n "$LINKING_SERVER" ]; then
+    # an already running serve_linking.sh keeps the index and caches warm
+    python linking_client.py --query --server $LINKING_SERVER
+else
+    python linking.py --query --index-dir $index_dir --country-codes "${@}"
+fi
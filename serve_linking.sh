@@ -0,0 +1,14 @@
+#!/bin/bash
+
+# address is host:port or unix:/path/to/socket
+[ $# -lt 2 ] && { echo "Usage: $0 lucene_index_dir/ address [country_code1] [country_code2] ..."; exit 1; }
+index_dir=$(readlink -ve $1) || exit 1
+address=$2
+
+cd $(dirname $0)
+
+source activate xy_linking
+set -x
+
+shift 2
+python linking.py --serve $address --index-dir $index_dir --country-codes "${@}"
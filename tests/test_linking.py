@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# python -m unittest discover tests, needs no lucene: the linker runs on the sqlite backend
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import linking
+from linking import Candidate, EntityLinker, SqliteIndexer, iou
+
+
+def build_index(index_dir, docs):
+    path = os.path.join(index_dir, 'sqlite_index.sqlite')
+    indexer = SqliteIndexer(path)
+    for doc in docs:
+        indexer.index(*doc)
+    indexer.close()
+    return path
+
+
+class FuzzyLinkingTest(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        path = build_index(self.index_dir, [
+            ('1', 'Москва', 'Moscow', 'GPE', 'RU\tcity,village,...\t'),
+            ('2', 'Мозква', 'Mozkva', 'GPE', 'RU\tcountry,state,region,...\thttp://en.wikipedia.org/wiki/Mozkva'),
+        ])
+        self.linker = EntityLinker(path, ['RU'], backend='sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def link(self, mention):
+        result = self.linker.query({'mention': mention, 'type': 'ldcOnt:GPE'}, '')
+        return result if result == 'none' else [candidate['id'] for candidate in result]
+
+    def test_capitalized_cyrillic_mention(self):
+        # one edit from Москва, two from Мозква: the distance 1 group has to win
+        self.assertEqual(self.link('Москвы'), ['1'])
+        self.assertEqual(self.link('москвы'), ['1'])
+
+    def test_edit_distance_groups(self):
+        candidates = self.linker.search_candidates('Москвы'.lower(), 2, linking.CANDIDATE_TYPES['GPE'])
+        groups = self.linker.group_by_edit_distance(candidates, 'Москвы'.lower(), 2)
+        self.assertEqual([[candidate['id'] for candidate in group] for group in groups], [['1'], ['1', '2']])
+
+
+# --
+# score_candidates and disamb as they were before candidate_features split the score into addends
+
+def reference_score_candidates(candidates, ent_name, ent_type, country_codes):
+    # filter by type
+    if ent_type == 'GPE' or ent_type == 'LOC' or ent_type == 'FAC':
+        candidates = filter(lambda x: x['type'] in ['GPE', 'LOC', 'FAC'], candidates)
+    elif ent_type == 'ORG':
+        candidates = filter(lambda x: x['type'] == 'ORG', candidates)
+    elif ent_type == 'PER':
+        candidates = filter(lambda x: x['type'] == 'PER', candidates)
+    else:
+        return None
+
+    # remove duplication
+    candidate_ids = set()
+    filtered_candidates = []
+    for candidate in candidates:
+        if candidate['id'] in candidate_ids:
+            continue
+        candidate_ids.add(candidate['id'])
+        filtered_candidates.append(candidate)
+    candidates = filtered_candidates
+    if len(candidates) == 1:
+        return candidates
+
+    scores = [0 for _ in candidates]
+    # find exact match
+    for i, candidate in enumerate(candidates):
+        for _key in ['name', 'CannonicalName']:
+            if candidate[_key].lower().encode('utf-8') == ent_name:
+                scores[i] += 1
+            elif ent_name in candidate[_key].lower().encode('utf-8'):
+                scores[i] += 0.5
+
+    # filter by type
+    for i, candidate in enumerate(candidates):
+        if candidate['type'] == ent_type:
+            scores[i] += 1
+
+    # filter by wiki
+    for i, candidate in enumerate(candidates):
+        if candidate['info'] == '': continue
+        if len(candidate['info'].split('\t')) == 3:
+            scores[i] += 1
+            _wiki_link = candidate['info'].split('\t')[2].encode('utf-8')
+            _wiki_link = _wiki_link.split("|")[0]  # split if there are too many
+            if _wiki_link.startswith("http://en.wikipedia.org/wiki/"):
+                wiki_entry = _wiki_link[len("http://en.wikipedia.org/wiki/"):]
+                if wiki_entry.lower() == ent_name:
+                    scores[i] += 1  # directly hit
+                else:  # prefer shorter entry!
+                    scores[i] += 0.5 * len(ent_name)/len(wiki_entry)
+
+    # filter by country
+    if ent_type == 'GPE' or ent_type == 'LOC':
+        for i, candidate in enumerate(candidates):
+            if candidate['info'] == '': continue
+            if candidate['info'].split('\t')[1] == 'country,state,region,...':
+                scores[i] += 1
+            if candidate['info'].split('\t')[1] == 'city,village,...':
+                scores[i] += 0.5
+            if candidate['info'].split('\t')[0] in country_codes:
+                scores[i] += 1
+            if candidate['info'].split('\t')[0] == 'US' or candidate['info'].split('\t')[0] == 'CA':
+                scores[i] -= 0.5
+
+    max_score = -1
+    final_candidates = None
+    for candidate, score in zip(candidates, scores):
+        if score > max_score:
+            max_score = score
+            final_candidates = [candidate]
+        elif score == max_score:
+            final_candidates.append(candidate)
+    return final_candidates
+
+def reference_disamb(candidates, ent_name, ent_type, sentence):
+    edit_score = [1./(abs(len(candidate['name']) - len(ent_name)) + 1) for candidate in candidates]
+    context_score = [0 for _ in range(len(candidates))]
+    if ent_type == 'PER':
+        for c, candidate in enumerate(candidates):
+            info = candidate['info']
+            context_score[c] = iou(info, sentence) * 5
+            if 'Venezuela' in info:
+                context_score[c] += 1
+    elif ent_type == 'ORG':
+        for c, candidate in enumerate(candidates):
+            info = candidate['info']
+            context_score[c] = iou(info, sentence) * 5
+
+    scores = [0 for _ in range(len(candidates))]
+    for i in range(len(candidates)):
+        scores[i] = edit_score[i] + context_score[i]
+    score_sum = sum(scores)
+    for i in range(len(candidates)):
+        candidates[i]['confidence'] = scores[i] / score_sum
+    candidates.sort(key=lambda x: -x['confidence'])
+    return candidates
+# --
+
+NAMES = [u'Kyiv', u'kyiv', u'Kyiv Oblast', u'Київ', u'Москва', u'Moscow', u'Nicolas Maduro', u'Maduro', u'Gazprom']
+# GPE/LOC/FAC rows have country, feature and wiki columns, the others free text
+GPE_INFOS = [u'', u'UA\tcity,village,...\t', u'RU\tcountry,state,region,...\thttp://en.wikipedia.org/wiki/Moscow',
+             u'US\tcity,village,...\thttp://en.wikipedia.org/wiki/Kyiv|http://en.wikipedia.org/wiki/Kiev',
+             u'CA\tcountry,state,region,...\thttp://ru.wikipedia.org/wiki/Kyiv',
+             u'RU\tx\thttp://en.wikipedia.org/wiki/Kyiv_Oblast']
+OTHER_INFOS = [u'', u'Venezuela President\tb\tc', u'gas company of Russia', u'UA\tx\thttp://en.wikipedia.org/wiki/Kyiv']
+
+def random_candidates(rnd):
+    fields = []
+    for _ in range(rnd.randint(0, 12)):
+        type = rnd.choice(['GPE', 'LOC', 'FAC', 'PER', 'ORG'])
+        fields.append({'id': unicode(rnd.randint(0, 8)), 'name': rnd.choice(NAMES), 'CannonicalName': rnd.choice(NAMES),
+                       'type': type, 'info': rnd.choice(GPE_INFOS if type in ('GPE', 'LOC', 'FAC') else OTHER_INFOS)})
+    return fields
+
+
+class ScoringRegressionTest(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.linker = EntityLinker(build_index(self.index_dir, [('1', 'Kyiv', 'Kyiv', 'GPE', '')]),
+                                   ['UA'], backend='sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def test_same_winners_and_confidences(self):
+        rnd = random.Random(0)
+        for _ in range(2000):
+            fields = random_candidates(rnd)
+            ent_name = rnd.choice(NAMES).lower().encode('utf-8')
+            ent_type = rnd.choice(['GPE', 'LOC', 'FAC', 'PER', 'ORG', 'VEH'])
+            sentence = rnd.choice(['', 'Venezuela President Maduro', 'gas company of Russia'])
+            expected = reference_score_candidates([Candidate(f) for f in fields], ent_name, ent_type, ['UA'])
+            found = self.linker.score_candidates([Candidate(f) for f in fields], ent_name, ent_type)
+            self.assertEqual(found, expected)
+            if expected and len(expected) > 1:
+                expected = reference_disamb(expected, ent_name, ent_type, sentence)
+                found = self.linker.disamb(found, ent_name, ent_type, sentence)
+                self.assertEqual([(c['id'], c['name'], c['confidence']) for c in found],
+                                 [(c['id'], c['name'], c['confidence']) for c in expected])
+
+
+if __name__ == '__main__':
+    unittest.main()